@@ -0,0 +1,357 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+from zipfile import ZipFile, ZIP_STORED
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+import geopandas
+from shapely.geometry import Polygon
+
+from sentinelsat_glacier_definitions import GLACIERS
+from sentinelsat_functions import unzip_images, glacier_scenes, render_scenes
+from sentinelsat_layers import OUTLINE_PATH
+from sentinelsat_instrumentation import drain_records, summarize_records
+
+"""
+Benchmark of the processing pipeline on synthetic Sentinel-2 tiles. Runs entirely offline.
+
+For each glacier, synthetic B02, B03 and B04 images are made for every tile of the glacier (tile_relorb_dict) on the
+Sentinel-2 tile grid of its UTM zone: tiles are 109.8 km wide, and start at the 100 km square given by the letters of
+the tile ID. To keep the generation fast, each image only covers the glacier bounding box plus a margin, but its pixels
+are on the grid of the full tile. The images of each date are packed into a SAFE-like product zip-file, and a synthetic
+ice extent outline is written in place of the overlay shapefile.
+
+The benchmark times
+unzip: unzip_images of all product zip-files, for each number of workers
+grouping: glacier_scenes with the scene catalog rebuilt (cold) and read from disk (warm)
+render: render_scenes of all scenes, for each pixel size, engine and number of workers. The time of the stages inside
+(decode: windowed read of the tiles, normalize, reproject and savefig/render) are taken from the stage records (see
+sentinelsat_instrumentation.py)
+
+Each run is appended as a json line to results_path, with the git commit, platform and package versions, and compared
+with the last earlier run with the same parameters.
+
+Variables to specify:
+glacier_list: list of glaciers to make synthetic tiles for
+pixel_sizes: list of pixel sizes in meters. Scenes at 10 m have the size of real Sentinel-2 scenes, 20 and 40 m have 1/4 and 1/16 of the pixels
+dates: integer number of dates (scenes) for each glacier
+workers: list of the number of workers to time unzip_images and render_scenes with
+engines: list of rendering engines, 'matplotlib' and/or 'pil'
+driver: GDAL driver of the synthetic images. 'JP2OpenJPEG' (lossless JPEG2000, like the real images) or 'GTiff' (faster to make)
+repeat: integer number of times each benchmark is repeated. The fastest time is recorded
+n: root of each band in RGB-composite
+results_path: json lines file the results are appended to
+"""
+
+BENCHMARK_RESULTS_PATH = './benchmark_results.jsonl'
+TILE_SIZE = 109800 # Width and height of a Sentinel-2 tile in meters
+MARGIN = 2000 # Meters of synthetic image around the glacier bounding box
+BANDS = ('B02', 'B03', 'B04')
+FIRST_DATE = datetime(2020, 7, 1, 15, 16, 41)
+
+
+def tile_origin(glacier, tile):
+    """
+    Returns the (x, y) of the upper left corner of tile in the UTM projection of glacier. The 100 km square of each tile
+    is found from the column and row letters of the tile IDs of the glacier, counted from the square of the lower left
+    corner of the glacier bounding box.
+    """
+    record = GLACIERS[glacier]
+    minx, miny, maxx, maxy = record.utm_bounds
+    columns = sorted(set(t[3] for t in record.tile_relorb_dict))
+    rows = sorted(set(t[4] for t in record.tile_relorb_dict))
+    x = (minx // 100000 + columns.index(tile[3])) * 100000
+    y = (miny // 100000 + rows.index(tile[4])) * 100000
+    return x, y + 100000 # Tiles extend TILE_SIZE from the upper left corner, overlapping the squares east and south
+
+
+def synthetic_band(x, y, band, day):
+    """
+    Returns a uint16 band with smooth features and noise, at the map coordinates x and y (2D float32 arrays). Features
+    are functions of the map coordinates, so overlapping tiles have the same values. A slanted strip west of the swath
+    edge, which moves with day, has no data (0).
+    """
+    rng = np.random.default_rng(day * 10 + int(band[1:]))
+    values = 2000 + 1500 * np.sin(x / 3100 + int(band[1:])) * np.cos(y / 2300) + 800 * np.sin((x + y) / 900)
+    values += 150 * rng.standard_normal(x.shape, dtype=np.float32)
+    values = np.clip(values, 1, 10000).astype(np.uint16)
+    values[x + 0.3 * y < x.min() + 0.3 * y.max() + 1000 * (day % 3)] = 0
+    return values
+
+
+def make_product(glacier, date, day, pixel_size, directory, driver):
+    """
+    Writes the synthetic band images of all tiles of glacier for date to directory
+
+    returns: dict of product title: list of image paths
+    """
+    record = GLACIERS[glacier]
+    minx, miny, maxx, maxy = record.utm_bounds
+    products = {}
+    for tile, orbits in sorted(record.tile_relorb_dict.items()):
+        x0, y0 = tile_origin(glacier, tile)
+        # Part of the tile inside the bounding box plus margin, on the pixel grid of the tile
+        left = max(x0, x0 + (minx - MARGIN - x0) // pixel_size * pixel_size)
+        top = min(y0, y0 - (y0 - maxy - MARGIN) // pixel_size * pixel_size)
+        right = min(x0 + TILE_SIZE, maxx + MARGIN)
+        bottom = max(y0 - TILE_SIZE, miny - MARGIN)
+        if right <= left or top <= bottom:
+            continue
+        width = int(np.ceil((right - left) / pixel_size))
+        height = int(np.ceil((top - bottom) / pixel_size))
+        x, y = np.meshgrid(np.float32(left) + pixel_size * (np.arange(width, dtype=np.float32) + 0.5), np.float32(top) - pixel_size * (np.arange(height, dtype=np.float32) + 0.5))
+
+        title = 'S2A_MSIL1C_{}_N0209_R{:03d}_T{}_{}'.format(date, orbits[0], tile, date[:8] + 'T235959')
+        products[title] = []
+        for band in BANDS:
+            path = os.path.join(directory, 'T{}_{}_{}.jp2'.format(tile, date, band))
+            options = {'QUALITY': 100, 'REVERSIBLE': 'YES'} if driver == 'JP2OpenJPEG' else {'TILED': 'YES'}
+            with rasterio.open(path, 'w', driver=driver, width=width, height=height, count=1, dtype='uint16', crs='epsg:{}'.format(record.epsg), transform=from_origin(left, top, pixel_size, pixel_size), **options) as dataset:
+                dataset.write(synthetic_band(x, y, band, day), 1)
+            products[title].append(path)
+    return products
+
+
+def zip_product(title, image_paths, directory):
+    """
+    Packs image_paths into a SAFE-like product zip-file <title>.zip in directory, with the images in the GRANULE/IMG_DATA
+    folder of the tile like in the real products. JPEG2000 is already compressed, so the images are stored as they are.
+    """
+    tile = title.split('_')[5]
+    granule = '{}.SAFE/GRANULE/L1C_{}_A000000_{}/IMG_DATA'.format(title, tile, title.split('_')[2])
+    with ZipFile(os.path.join(directory, title + '.zip'), 'w', ZIP_STORED) as zipObject:
+        zipObject.writestr('{}.SAFE/manifest.safe'.format(title), '<?xml version="1.0"?><xfdu:XFDU/>')
+        for path in image_paths:
+            zipObject.write(path, '{}/{}'.format(granule, os.path.basename(path)))
+
+
+def make_outline(glacier_list, path):
+    """
+    Writes a synthetic ice extent outline shapefile to path, with a polygon across the middle of the bounding box of
+    each glacier
+    """
+    polygons = []
+    for glacier in glacier_list:
+        minlon, minlat, maxlon, maxlat = GLACIERS[glacier].bounding_box
+        lon = (minlon + maxlon) / 2
+        polygons.append(Polygon([(minlon - 1, minlat - 1), (lon, minlat - 1), (lon - 0.1, (minlat + maxlat) / 2), (lon, maxlat + 1), (minlon - 1, maxlat + 1)]))
+    geopandas.GeoDataFrame({'id': list(range(len(polygons)))}, geometry=polygons, crs='epsg:4326').to_file(path)
+
+
+def make_dataset(glacier_list, pixel_size, dates, directory, driver):
+    """
+    Makes the synthetic images and product zip-files for pixel_size in directory/<pixel_size>m, with folders
+    zip: product zip-files, images: the same images already extracted
+
+    returns: path of the folder
+    """
+    folder = os.path.join(directory, '{}m'.format(pixel_size))
+    os.makedirs(os.path.join(folder, 'zip'))
+    os.makedirs(os.path.join(folder, 'images'))
+    for day in range(dates):
+        date = (FIRST_DATE + timedelta(days=day)).strftime('%Y%m%dT%H%M%S')
+        for glacier in glacier_list:
+            for title, image_paths in make_product(glacier, date, day, pixel_size, os.path.join(folder, 'images'), driver).items():
+                zip_product(title, image_paths, os.path.join(folder, 'zip'))
+    return folder
+
+
+def _fastest(function, repeat, setup=None):
+    """
+    Returns the fastest of repeat timings in seconds of function(), calling setup() untimed before each
+    """
+    timings = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def _reset_directory(directory):
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def benchmark_unzip(folder, workers, repeat):
+    """
+    Times unzip_images of the product zip-files in folder for each number of workers
+    """
+    download_directory = os.path.join(folder, 'download')
+    image_directory = os.path.join(folder, 'unzipped')
+
+    def setup():
+        _reset_directory(image_directory)
+        shutil.copytree(os.path.join(folder, 'zip'), download_directory, dirs_exist_ok=True)
+
+    results = []
+    for w in workers:
+        seconds = _fastest(lambda: unzip_images(download_directory, image_directory, ('B02.jp2', 'B03.jp2', 'B04.jp2'), w), repeat, setup)
+        results.append({'benchmark': 'unzip', 'workers': w, 'seconds': seconds})
+    return results
+
+
+def benchmark_grouping(folder, glacier_list, repeat):
+    """
+    Times glacier_scenes for all glaciers, with the scene catalog rebuilt (cold) and read from disk (warm)
+    """
+    image_directory = os.path.join(folder, 'images')
+
+    def group():
+        return [scene for glacier in glacier_list for scene in glacier_scenes(glacier, image_directory)]
+
+    def remove_catalog():
+        shutil.rmtree(os.path.join(image_directory, '.store'), ignore_errors=True)
+
+    return [
+            {'benchmark': 'grouping_cold', 'seconds': _fastest(group, repeat, remove_catalog)},
+            {'benchmark': 'grouping_warm', 'seconds': _fastest(group, repeat)},
+    ]
+
+
+def benchmark_render(folder, glacier_list, n, workers, engines, repeat):
+    """
+    Times render_scenes of all scenes in folder for each engine and number of workers, with the mean time of each
+    stage inside (decode, normalize, reproject, savefig/render) from the stage records
+    """
+    image_directory = os.path.join(folder, 'images')
+    output_directory = os.path.join(folder, 'output')
+    scenes = [scene for glacier in glacier_list for scene in glacier_scenes(glacier, image_directory)]
+    results = []
+    for engine in engines:
+        for w in workers:
+            failed = []
+            def render():
+                failed[:] = [r for r in render_scenes(scenes, n, output_directory, w, engine) if not r['success']] # Of the last repeat
+
+            drain_records()
+            seconds = _fastest(render, repeat, lambda: _reset_directory(output_directory))
+            stages = summarize_records(drain_records())['stages']
+            for r in failed[:1]:
+                print('Failed to render {} {} with {}. Reason: {}'.format(r['glacier'], r['date'], engine, r['error']))
+            results.append({
+                            'benchmark': 'render',
+                            'engine': engine,
+                            'workers': w,
+                            'scenes': len(scenes),
+                            'failed': len(failed),
+                            'seconds': seconds,
+                            'stages': {name: s['mean_seconds'] for name, s in stages.items()},
+                            'peak_rss_mb': max([s['peak_rss_mb'] for s in stages.values()] or [0]),
+            })
+    return results
+
+
+def _environment():
+    """
+    Returns a dict with the git commit, platform and versions the benchmark is run with
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+            'commit': commit,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'rasterio': rasterio.__version__,
+            'gdal': rasterio.__gdal_version__,
+    }
+
+
+def _key(result):
+    return tuple((k, result.get(k)) for k in ('benchmark', 'pixel_size', 'engine', 'workers'))
+
+
+def previous_run(parameters, results_path=BENCHMARK_RESULTS_PATH):
+    """
+    Returns the last run in results_path with the same parameters, or None
+    """
+    previous = None
+    if os.path.exists(results_path):
+        with open(results_path, 'r') as file:
+            for line in file:
+                run = json.loads(line)
+                if run['parameters'] == parameters:
+                    previous = run
+    return previous
+
+
+def report_benchmark(run, previous=None):
+    """
+    Prints the results of run, and the change from previous if given
+    """
+    before = {_key(r): r['seconds'] for r in (previous or {}).get('results', [])}
+    print('Benchmark at commit {} on {}'.format(run['environment']['commit'], run['environment']['platform']))
+    if previous is not None:
+        print('Compared with commit {} at {}'.format(previous['environment']['commit'], previous['time']))
+    for r in run['results']:
+        label = ' '.join('{}={}'.format(k, v) for k, v in _key(r)[1:] if v is not None)
+        change = ''
+        if _key(r) in before:
+            change = '{:+.0%}'.format(r['seconds'] / before[_key(r)] - 1)
+        stages = ', '.join('{} {:.2f}'.format(name, seconds) for name, seconds in sorted(r.get('stages', {}).items()))
+        print('{:<14} {:<36} {:>9.3f} s {:>6}  {}'.format(r['benchmark'], label, r['seconds'], change, stages))
+
+
+def run_benchmark(glacier_list, pixel_sizes, dates, workers, engines, driver='JP2OpenJPEG', repeat=3, n=2, results_path=BENCHMARK_RESULTS_PATH, keep_directory=None):
+    """
+    Makes the synthetic data in a temporary directory, runs the benchmarks, and appends the results to results_path
+
+    keep_directory: string containing a directory to make the synthetic data in and keep afterwards. Defaults to None
+    (temporary directory, deleted afterwards)
+
+    returns: dict with the parameters, environment and results of the run
+    """
+    parameters = {'glacier_list': glacier_list, 'pixel_sizes': pixel_sizes, 'dates': dates, 'workers': workers, 'engines': engines, 'driver': driver, 'repeat': repeat, 'n': n}
+    results_path = os.path.abspath(results_path)
+    directory = keep_directory or tempfile.mkdtemp(prefix='sentinelsat_benchmark_')
+    os.makedirs(directory, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(directory) # The overlay is read from OUTLINE_PATH, relative to the working directory
+    try:
+        make_outline(glacier_list, OUTLINE_PATH)
+        results = []
+        for pixel_size in pixel_sizes:
+            start = time.perf_counter()
+            folder = make_dataset(glacier_list, pixel_size, dates, directory, driver)
+            print('Made synthetic {} m images in {:.1f} s'.format(pixel_size, time.perf_counter() - start))
+            for result in benchmark_unzip(folder, workers, repeat) + benchmark_grouping(folder, glacier_list, repeat) + benchmark_render(folder, glacier_list, n, workers, engines, repeat):
+                result['pixel_size'] = pixel_size
+                results.append(result)
+    finally:
+        os.chdir(cwd)
+        if keep_directory is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    run = {'time': datetime.now().isoformat(timespec='seconds'), 'parameters': parameters, 'environment': _environment(), 'results': results}
+    report_benchmark(run, previous_run(parameters, results_path))
+    with open(results_path, 'a') as file:
+        file.write(json.dumps(run) + '\n')
+    return run
+
+
+# Variables passed to function
+glacier_list = ['Jakobshavn', 'Ryder']
+pixel_sizes = [40, 20, 10]
+dates = 4
+workers = [1, 2, 4]
+engines = ['matplotlib', 'pil']
+driver = 'JP2OpenJPEG'
+repeat = 3
+n = 2
+results_path = BENCHMARK_RESULTS_PATH
+
+if __name__ == '__main__': # Required for the worker processes of render_scenes
+    run_benchmark(glacier_list, pixel_sizes, dates, workers, engines, driver, repeat, n, results_path)
@@ -0,0 +1,154 @@
+import json
+import os
+import re
+from collections import namedtuple
+
+from sentinelsat_product_store import MANIFEST_NAME, load_manifest, store_path
+
+"""
+Functions to keep a catalog of the band images in the unprocessed image directory.
+
+Each image filename, e.g. 'T22WEB_20200701T151641_B02.jp2', is parsed once into a BandRecord. The relative orbit
+is not part of the filename, and is taken from the title of the product the image was extracted from (see
+sentinelsat_product_store.py), or None if not known.
+
+The catalog is stored as .store/scene_catalog.json in the image directory, and the band records are only rebuilt when
+the directory or the product manifest (which gives the orbits) has changed. Their modification times are read before
+the directory is listed and stored in the catalog, so an image added while the catalog is built makes it stale. The catalog also keeps the quality of each scene (see
+scene_quality in sentinelsat_functions.py), keyed by '<glacier>|<date>', so scenes of poor quality are skipped in later
+runs without reading their images again. A quality entry is only used while the images of the scene are unchanged.
+"""
+
+CATALOG_NAME = 'scene_catalog.json'
+
+BandRecord = namedtuple('BandRecord', ['filename', 'tile', 'datetime', 'band', 'relative_orbit'])
+
+BAND_FILENAME = re.compile(r'^T(?P<tile>\d{2}[A-Z]{3})_(?P<datetime>\d{8}T\d{6})_(?P<band>B\d[\dA]|TCI)\.jp2$')
+PRODUCT_ORBIT = re.compile(r'_R(?P<relative_orbit>\d{3})_')
+
+
+def parse_band_filename(filename, relative_orbit=None):
+    """
+    Returns the BandRecord of the band image filename, or None if filename is not a Sentinel-2 band image
+    filename: string with the filename, e.g. 'T22WEB_20200701T151641_B02.jp2'
+    relative_orbit: integer relative orbit of the product the image belongs to. Optional
+    """
+    match = BAND_FILENAME.match(os.path.basename(filename))
+    if match is None:
+        return None
+    return BandRecord(os.path.basename(filename), match.group('tile'), match.group('datetime'), match.group('band'), relative_orbit)
+
+
+def _product_orbits(image_directory):
+    """
+    Returns a dict of image filename: relative orbit, from the product titles in the manifest of image_directory
+    """
+    orbits = {}
+    for title, entry in load_manifest(image_directory).items():
+        match = PRODUCT_ORBIT.search(title)
+        if match is not None:
+            for filename in entry['files']:
+                orbits[filename] = int(match.group('relative_orbit'))
+    return orbits
+
+
+def _read_catalog(catalog_path):
+    """
+    Returns (band records, quality, state) stored in catalog_path, with state as returned by _directory_state when the
+    band records were listed. Catalogs written before the scene quality was added only contain the list of band
+    records, and catalogs written before the state was added have state None.
+    """
+    if not os.path.exists(catalog_path):
+        return [], {}, None
+    with open(catalog_path, 'r') as file:
+        catalog = json.load(file)
+    if isinstance(catalog, list):
+        return [BandRecord(*record) for record in catalog], {}, None
+    return [BandRecord(*record) for record in catalog['bands']], catalog['quality'], catalog.get('state')
+
+
+def _write_catalog(catalog_path, records, quality, state):
+    with open(catalog_path + '.tmp', 'w') as file:
+        json.dump({'bands': records, 'quality': quality, 'state': state}, file)
+    os.replace(catalog_path + '.tmp', catalog_path)
+
+
+def _directory_state(image_directory):
+    """
+    Returns [modification time of image_directory, modification time of its product manifest (None if there is none)]
+    in ns
+    """
+    manifest_path = store_path(image_directory, MANIFEST_NAME)
+    manifest_mtime = os.stat(manifest_path).st_mtime_ns if os.path.exists(manifest_path) else None
+    return [os.stat(image_directory).st_mtime_ns, manifest_mtime]
+
+
+def load_catalog(image_directory):
+    """
+    Returns a list of BandRecords for the band images in image_directory. The directory is only listed again if it
+    or the product manifest has changed since the catalog was built.
+    """
+    catalog_path = store_path(image_directory, CATALOG_NAME)
+    state = _directory_state(image_directory) # Before listing, so changes during the listing are found next time
+    records, quality, catalog_state = _read_catalog(catalog_path)
+    if catalog_state == state:
+        return records
+
+    orbits = _product_orbits(image_directory)
+    records = []
+    with os.scandir(image_directory) as entries:
+        for entry in entries:
+            record = parse_band_filename(entry.name, orbits.get(entry.name))
+            if record is not None:
+                records.append(record)
+    records.sort()
+
+    _write_catalog(catalog_path, records, quality, state)
+    return records
+
+
+def index_scenes(records):
+    """
+    Returns a dict of (tile, datetime): dict of band: BandRecord
+    records: list of BandRecords, as returned by load_catalog
+    """
+    index = {}
+    for record in records:
+        index.setdefault((record.tile, record.datetime), {})[record.band] = record
+    return index
+
+
+def _image_state(image_list):
+    """
+    Returns the name and size of each image in image_list, to tell if a stored scene quality is still valid
+    """
+    return [[os.path.basename(image), os.path.getsize(image)] for image in sorted(image_list)]
+
+
+def cached_quality(image_directory, scenes):
+    """
+    Returns a dict of (glacier, date): quality dict for the scenes with a stored quality for their current images
+    scenes: list of (glacier, date, image_list) tuples, as returned by glacier_scenes
+    """
+    quality = _read_catalog(store_path(image_directory, CATALOG_NAME))[1]
+    cached = {}
+    for glacier, date, image_list in scenes:
+        entry = quality.get('{}|{}'.format(glacier, date))
+        if entry is not None and entry['images'] == _image_state(image_list):
+            cached[(glacier, date)] = entry
+    return cached
+
+
+def record_quality(image_directory, scenes, results):
+    """
+    Stores the quality of the scenes in the catalog of image_directory
+    scenes: list of (glacier, date, image_list) tuples
+    results: list of dicts as returned by render_scenes, in the order of scenes. Results without a 'quality' are left out
+    """
+    records = load_catalog(image_directory) # Brings the band records up to date, as they are written with the quality
+    catalog_path = store_path(image_directory, CATALOG_NAME)
+    quality, state = _read_catalog(catalog_path)[1:]
+    for (glacier, date, image_list), result in zip(scenes, results):
+        if result.get('quality') is not None and all(os.path.exists(image) for image in image_list):
+            quality['{}|{}'.format(glacier, date)] = dict(result['quality'], images=_image_state(image_list))
+    _write_catalog(catalog_path, records, quality, state)
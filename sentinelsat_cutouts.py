@@ -0,0 +1,130 @@
+import json
+import os
+
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import RasterioIOError
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as copy_dataset
+
+"""
+Functions to keep a store of cutouts: the merged window of a glacier cut from the band images of a scene, as made by
+mosaic_tiles in sentinelsat_functions.py. Decoding the JPEG2000 tiles is the slowest part of making an image, so
+images made again with other parameters (e.g. n or the overlay) read the cutout instead.
+
+Each cutout is stored as <cutout_directory>/<glacier>/<glacier>_<date>.tif, a Cloud-Optimized GeoTIFF in the UTM grid
+of the images, at the resolution the image is made at. It has the red, green and blue bands (uint16 like the images),
+a mask of the pixels with data, deflate compression in CUTOUT_BLOCK_SIZE tiles, and overviews, so a part of it or a
+coarser version can be read without reading the whole file.
+
+The cutout is tagged with its key: the name and size of each band image, the bounds and the decimation factor. A
+cutout is only used while the key is unchanged, and is written again otherwise.
+
+The modification time of a cutout is set when it is written or read, and the size of the store is bounded by
+evict_cutouts, which deletes the least recently used cutouts, like the image store (see sentinelsat_product_store.py).
+"""
+
+CUTOUT_BLOCK_SIZE = 512 # Width and height in pixels of the tiles of the cutouts
+CUTOUT_VERSION = 2 # Increase when the content of the cutouts changes, to write all cutouts again
+MAX_CUTOUT_BYTES = 50e9 # Default maximum size of the cutout store
+
+
+def cutout_path(cutout_directory, glacier, date):
+    """
+    Returns the path of the cutout of glacier at date (str formatted "YYYYMMDDTHHMMSS") in cutout_directory
+    """
+    return os.path.join(cutout_directory, glacier, '{}_{}.tif'.format(glacier, date))
+
+
+def cutout_key(image_list, bounds, factor):
+    """
+    Returns the key (json string) of the cutout made from image_list, covering bounds at decimation factor
+    """
+    images = [[os.path.basename(image), os.path.getsize(image)] for image in sorted(image_list)]
+    return json.dumps({'images': images, 'bounds': [float(b) for b in bounds], 'factor': factor, 'version': CUTOUT_VERSION}, sort_keys=True)
+
+
+def read_cutout(path, key):
+    """
+    Reads the cutout in path, if it exists and has key
+
+    returns: (tci, coverage, transform) as returned by mosaic_tiles, or None if there is no cutout with key
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with rasterio.open(path) as cutout:
+            if cutout.tags().get('CUTOUT_KEY') != key:
+                return None
+            tci, coverage, transform = cutout.read(), cutout.read_masks(1) > 0, cutout.transform
+    except RasterioIOError as e: # E.g. a cutout truncated by running out of disk space
+        print('Failed to read cutout {}. Reason: {}'.format(path, e))
+        return None
+    os.utime(path) # Marks the cutout as used now, so it is the last to be evicted
+    return tci, coverage, transform
+
+
+def write_cutout(path, key, tci, coverage, transform, crs):
+    """
+    Writes tci and coverage, as returned by mosaic_tiles, as a cutout with key to path. The cutout is made in memory
+    and copied to a temporary file that is renamed when complete, so an interrupted run does not leave a half-written
+    cutout behind.
+
+    crs: projection of tci, e.g. the crs of the band images
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    profile = {
+               'driver': 'GTiff',
+               'count': 3,
+               'dtype': tci.dtype,
+               'height': tci.shape[1],
+               'width': tci.shape[2],
+               'crs': crs,
+               'transform': transform,
+               'tiled': True,
+               'blockxsize': CUTOUT_BLOCK_SIZE,
+               'blockysize': CUTOUT_BLOCK_SIZE,
+    }
+    # Overviews down to a single tile
+    overviews = []
+    factor = 2
+    while max(tci.shape[1:]) / factor >= CUTOUT_BLOCK_SIZE / 2:
+        overviews.append(factor)
+        factor *= 2
+
+    with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True):
+        with MemoryFile() as memory_file:
+            with memory_file.open(**profile) as cutout:
+                cutout.write(tci)
+                cutout.write_mask(coverage)
+                cutout.update_tags(CUTOUT_KEY=key)
+                if overviews:
+                    cutout.build_overviews(overviews, Resampling.average)
+            # Copying the overviews puts them before the full resolution tiles, which makes the file cloud-optimized
+            copy_dataset(memory_file.name, path + '.tmp', driver='GTiff', tiled=True, blockxsize=CUTOUT_BLOCK_SIZE, blockysize=CUTOUT_BLOCK_SIZE, compress='deflate', predictor=2, copy_src_overviews=True)
+    os.replace(path + '.tmp', path)
+
+
+def evict_cutouts(cutout_directory, max_bytes=MAX_CUTOUT_BYTES):
+    """
+    Deletes the least recently used cutouts until the cutouts in cutout_directory take up at most max_bytes
+
+    returns: list of paths of the evicted cutouts
+    """
+    cutouts = []
+    for root, folders, files in os.walk(cutout_directory):
+        for filename in files:
+            if filename.endswith('.tif'):
+                stat = os.stat(os.path.join(root, filename))
+                cutouts.append((stat.st_mtime, stat.st_size, os.path.join(root, filename)))
+    total_bytes = sum(size for mtime, size, path in cutouts)
+    evicted = []
+    for mtime, size, path in sorted(cutouts):
+        if total_bytes <= max_bytes:
+            break
+        os.remove(path)
+        total_bytes -= size
+        evicted.append(path)
+    if evicted:
+        print('Evicted {} cutouts from {}'.format(len(evicted), cutout_directory))
+    return evicted
@@ -0,0 +1,121 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+import rasterio
+from rasterio.env import get_gdal_config, set_gdal_config
+
+"""
+A pool of open rasterio datasets for the band images, shared by the functions of a process that read them.
+
+Opening a JPEG2000 image parses its header, so the images of a tile are opened once and kept open while they are
+used, e.g. for the scenes of several glaciers sharing the tile. At most MAX_OPEN_DATASETS are kept open. The least
+recently used dataset is closed when another one is opened, which bounds the file descriptors and memory held by open
+datasets on long runs. Datasets are keyed by path, size and modification time, so a replaced image is opened again.
+
+The header of each image (crs, transform, shape, ...) is cached per process by image_header, so finding the
+projection and window of a scene does not read the image again.
+
+GDAL keeps recently read blocks in a block cache of each process. Its size is set with set_gdal_cache, also for the
+worker processes started afterwards.
+"""
+
+MAX_OPEN_DATASETS = 64 # Datasets kept open in each process
+GDAL_CACHE_MB = 512 # Size of the GDAL block cache of each process in MB
+
+ImageHeader = namedtuple('ImageHeader', ['to_crs', 'crs', 'transform', 'shape', 'res', 'dtype'])
+
+_pool = OrderedDict() # (path, size, mtime): open dataset, least recently used first
+_stats = {'opened': 0, 'reused': 0, 'closed': 0}
+_lock = threading.Lock()
+
+
+def _dataset_key(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def open_dataset(path):
+    """
+    Returns the open dataset of the image in path from the pool, and opens it if it is not in the pool. The dataset
+    stays open until it is evicted or close_datasets is called, so it must not be closed by the caller.
+    """
+    key = _dataset_key(path)
+    with _lock:
+        if key in _pool:
+            _pool.move_to_end(key)
+            _stats['reused'] += 1
+            return _pool[key]
+        dataset = rasterio.open(path, 'r')
+        _pool[key] = dataset
+        _stats['opened'] += 1
+        while len(_pool) > MAX_OPEN_DATASETS:
+            _pool.popitem(last=False)[1].close()
+            _stats['closed'] += 1
+        return dataset
+
+
+def close_datasets():
+    """
+    Closes all datasets in the pool
+    """
+    with _lock:
+        while _pool:
+            _pool.popitem()[1].close()
+            _stats['closed'] += 1
+
+
+def dataset_stats():
+    """
+    Returns a dict with the number of datasets opened, reused from the pool and closed by this process, and the number
+    open now
+    """
+    with _lock:
+        return dict(_stats, open=len(_pool))
+
+
+def crs_string(crs):
+    """
+    Returns the projection crs as a string like 'epsg:32622', or its WKT if it has no EPSG code. Works with all
+    versions of rasterio, unlike crs.data['init'] which newer versions do not set.
+    """
+    epsg = crs.to_epsg()
+    return 'epsg:{}'.format(epsg) if epsg is not None else crs.to_wkt()
+
+
+@lru_cache(maxsize=4096)
+def _image_header(key):
+    dataset = open_dataset(key[0])
+    return ImageHeader(crs_string(dataset.crs), dataset.crs, dataset.transform, dataset.shape, dataset.res, dataset.dtypes[0])
+
+
+def image_header(path):
+    """
+    Returns the ImageHeader of the image in path, with
+    to_crs: string with the projection, e.g. 'epsg:32622'
+    crs: rasterio CRS of the image
+    transform: Affine transform
+    shape: (height, width) in pixels
+    res: (x, y) size of the pixels
+    dtype: data type of the first band
+    The header is only read the first time, and again if the image changes.
+    """
+    return _image_header(_dataset_key(path))
+
+
+def set_gdal_cache(megabytes=GDAL_CACHE_MB):
+    """
+    Sets the size of the GDAL block cache to megabytes, in this process and in worker processes started afterwards
+    """
+    os.environ['GDAL_CACHEMAX'] = str(int(megabytes)) # Inherited by worker processes
+    set_gdal_config('GDAL_CACHEMAX', int(megabytes))
+
+
+def gdal_cache_setting():
+    """
+    Returns the GDAL_CACHEMAX setting as a string, e.g. '512' (MB) or '5%', or None if GDAL uses its default (5% of the
+    memory)
+    """
+    value = get_gdal_config('GDAL_CACHEMAX') or os.environ.get('GDAL_CACHEMAX')
+    return str(value) if value is not None else None
@@ -1,6 +1,11 @@
 import ftplib
 import os
+import queue
 import shutil
+import threading
+import time
+
+from sentinelsat_instrumentation import stage
 
 """
 Script to upload plots to DMI server. Uploads files from
@@ -10,31 +15,145 @@ str: output_plots_uploaded
 
 Requires username and password for DMI ftp server stores as line 3 and 4 in ../username_password.txt
 
+The files are uploaded by a pool of worker threads, each with its own ftp session. A dropped connection is
+reopened and the upload retried with increasing delay. A partly uploaded file is resumed (REST) from the size already
+on the server, and a file is only moved to output_plots_uploaded once the size on the server matches the local size.
+
 Created by kaha on 25 Jun 2018
 Modified by oew on 10 Mar 2021
 """
-def sentinelsat_ftp_upload(output_plots_to_upload, output_plots_uploaded):
-    ftp = ftplib.FTP('ftpserver.dmi.dk')
-    print(ftp.getwelcome());
 
-    # Credentials are stored in txt file not shared in the public repo.
+FTP_HOST = 'ftpserver.dmi.dk'
+
+
+def ftp_credentials():
+    """
+    Returns (username, password) for the DMI ftp server. Credentials are stored in txt file not shared in the public repo.
+    """
     with open('../username_password.txt', 'r') as file:
         data = file.readlines()
         data = [d.replace('\n', '') for d in data]
-    USERNAME = data[2]
-    PASSWORD = data[3]
+    return data[2], data[3]
+
+
+def connect_ftp(host, port, username, password, directory):
+    """
+    Returns an ftp session logged in to host and placed in directory
+    """
+    ftp = ftplib.FTP()
+    ftp.connect(host, port, timeout=60)
+    ftp.login(username, password)
+    ftp.cwd(directory)
+    return ftp
+
+
+def remote_size(ftp, filename):
+    """
+    Returns the size of filename on the ftp server, or None if it does not exist
+    """
+    ftp.voidcmd('TYPE I') # SIZE is only reliable in binary mode
+    try:
+        return ftp.size(filename)
+    except ftplib.error_perm:
+        return None
+
 
-    ftpResponse = ftp.login(USERNAME, PASSWORD)
-    print(ftpResponse)
-    ftpResponse = ftp.cwd('upload')
-    print(ftpResponse)
+def upload_file(ftp, local_path):
+    """
+    Uploads local_path to the current directory of ftp. A partly uploaded file is resumed from the size already on the
+    server, and an already complete file is not uploaded again. Raises OSError if the size on the server does not match
+    the local size afterwards.
+    """
+    filename = os.path.basename(local_path)
+    local_size = os.path.getsize(local_path)
+    size = remote_size(ftp, filename)
+    if size != local_size:
+        offset = size if size is not None and size < local_size else 0
+        with open(local_path, 'rb') as file:
+            file.seek(offset)
+            ftp.storbinary('STOR {}'.format(filename), file, rest=offset or None)
+        size = remote_size(ftp, filename)
+    if size != local_size:
+        raise OSError('Size of {} on server is {}, expected {}'.format(filename, size, local_size))
 
-    upload_list = [i for i in os.listdir(output_plots_to_upload) if i.endswith('.png')]
+
+def upload_worker(file_queue, results, connect, output_plots_uploaded, retries, backoff):
+    """
+    Uploads the files in file_queue until it returns None, with its own ftp session. Each file is retried retries
+    times, reconnecting and waiting backoff * 2**attempt seconds between attempts. Uploaded files are moved to
+    output_plots_uploaded. Appends a dict with keys 'filename', 'success' and 'error' to results for each file.
+    """
+    ftp = None
+    while True:
+        local_path = file_queue.get()
+        if local_path is None:
+            break
+        upload_filename = os.path.basename(local_path)
+        with stage('ftp_file', filename=upload_filename) as fields:
+            for attempt in range(retries + 1):
+                fields['attempts'] = attempt + 1
+                try:
+                    if ftp is None:
+                        ftp = connect()
+                    upload_file(ftp, local_path)
+                except ftplib.all_errors as e:
+                    if ftp is not None:
+                        ftp.close()
+                    ftp = None
+                    if attempt == retries:
+                        print('Failed to upload {}. Reason: {}'.format(upload_filename, e))
+                        results.append({'filename': upload_filename, 'success': False, 'error': str(e)})
+                    else:
+                        time.sleep(backoff * 2**attempt)
+                else:
+                    try:
+                        shutil.move(local_path, os.path.join(output_plots_uploaded, upload_filename))
+                    except OSError as e: # Uploaded, but left in the upload folder, so it is uploaded again next run
+                        print('Uploaded {}, but failed to move it to {}. Reason: {}'.format(upload_filename, output_plots_uploaded, e))
+                        results.append({'filename': upload_filename, 'success': False, 'error': 'Failed to move: {}'.format(e)})
+                    else:
+                        print('Uploaded {}'.format(upload_filename))
+                        results.append({'filename': upload_filename, 'success': True, 'error': None})
+                    break
+    if ftp is not None:
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+
+
+def sentinelsat_ftp_upload(output_plots_to_upload, output_plots_uploaded, workers=4, retries=3, backoff=2, host=FTP_HOST, port=21, username=None, password=None, directory='upload'):
+    """
+    Uploads all .png files in output_plots_to_upload to the ftp server, and moves them to output_plots_uploaded
+
+    workers: integer number of concurrent ftp sessions
+    retries: integer number of times a failed upload is retried
+    backoff: seconds to wait before the first retry. Doubled for each retry
+    host, port, directory: ftp server, and directory on the server to upload to
+    username, password: ftp credentials. Defaults to None (read with ftp_credentials)
+
+    returns: list of dicts with keys 'filename', 'success' and 'error', one for each file
+    """
+    if username is None:
+        username, password = ftp_credentials()
+
+    def connect():
+        return connect_ftp(host, port, username, password, directory)
+
+    upload_list = sorted(i for i in os.listdir(output_plots_to_upload) if i.endswith('.png'))
+    file_queue = queue.Queue()
     for upload_filename in upload_list:
-        file = open(os.path.join(output_plots_to_upload, upload_filename), 'rb')
-        ftpCommand = "STOR {}".format(upload_filename);
-        ftpResponse = ftp.storbinary(ftpCommand, file)
-        print(ftpResponse)
-        print('Uploaded {}'.format(upload_filename))
-        shutil.move(os.path.join(output_plots_to_upload, upload_filename), os.path.join(output_plots_uploaded, upload_filename))
-    ftp.quit()
\ No newline at end of file
+        file_queue.put(os.path.join(output_plots_to_upload, upload_filename))
+
+    results = []
+    threads = [threading.Thread(target=upload_worker, args=(file_queue, results, connect, output_plots_uploaded, retries, backoff)) for i in range(min(workers, len(upload_list)))]
+    with stage('ftp', files=len(upload_list), workers=len(threads)):
+        for thread in threads:
+            file_queue.put(None) # One stop signal for each worker
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    failed = [r for r in results if not r['success']]
+    print('Uploaded {} of {} files'.format(len(results) - len(failed), len(results)))
+    return results
@@ -1,22 +1,40 @@
 import os
+import re
 import shutil
-from zipfile import ZipFile
+import tempfile
+import zlib
+from zipfile import ZipFile, BadZipFile
 from datetime import datetime
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 
-from sentinelsat import SentinelAPI, make_path_filter
+from dateutil.relativedelta import relativedelta
+from sentinelsat import SentinelAPI
 import matplotlib.pyplot as plt
 import rasterio
 import rasterio.plot
-import geopandas
 from matplotlib_scalebar.scalebar import ScaleBar
-from pyproj import Transformer
 import numpy as np
 
-from rasterio.windows import Window
-from rasterio.transform import TransformMethodsMixin
+from rasterio.windows import Window, union
+from affine import Affine
+from shapely import wkt
 
-from sentinelsat_glacier_definitions import glacier_definitions
+from sentinelsat_glacier_definitions import glacier_definitions, glacier_utm_bounds
+from sentinelsat_catalog import load_catalog, index_scenes, parse_band_filename, cached_quality, record_quality
+from sentinelsat_datasets import open_dataset, close_datasets, dataset_stats, image_header
+from sentinelsat_cutouts import cutout_path, cutout_key, read_cutout, write_cutout
+from sentinelsat_layers import clipped_outline
+from sentinelsat_ledger import LEDGER_PATH, pending_scenes, record_scenes
+from sentinelsat_render import render_image
+from sentinelsat_product_store import new_products, product_key, register_products, touch_files, evict_products
+from sentinelsat_instrumentation import stage, drain_records, add_records, reset_records, report_summary
+
+OUTPUT_WIDTH = 2280 # Width in pixels of the large (LA) image
+QUALITY_SAMPLE_WIDTH = 256 # Minimum width in pixels of the window read to find the quality of a scene
+BRIGHT_VALUE = 7000 # Band value (reflectance * 10000) above which a pixel is counted as bright (cloud) in all three bands
+RELATIVE_DATE = re.compile(r'^NOW(-(?P<count>\d+)(?P<unit>DAY|MONTH|YEAR)S?)?$')
 
 
 def delete_everything_in_directory(download_directory):
@@ -38,43 +56,428 @@ def delete_everything_in_directory(download_directory):
             print('Failed to delete {}. Reason: {}'.format(file_path, e))
 
 
-def unzip_images(download_directory, image_directory, image_type):
+def extract_zip(zip_path, image_directory, image_type):
+    """
+    Extracts the images of image_type in the zip-file zip_path directly to image_directory, without their folders.
+    Each image is streamed to a temporary file of its own that is renamed when complete, so an interrupted extraction
+    does not leave a truncated image behind, and zip-files extracted at the same time with the same band filenames (e.g.
+    products of another processing baseline) do not write into the same file. Images that already exist in
+    image_directory with the same size are skipped.
+
+    returns: list of image filenames of image_type in the zip-file
+    """
+    files = []
+    with ZipFile(zip_path, 'r') as zipObject:
+        for info in zipObject.infolist():
+            if not info.filename.endswith(image_type):
+                continue
+            filename = os.path.basename(info.filename)
+            files.append(filename)
+            target_path = os.path.join(image_directory, filename)
+            if os.path.exists(target_path) and os.path.getsize(target_path) == info.file_size:
+                continue
+            handle, part_path = tempfile.mkstemp(suffix='.part', prefix=filename + '.', dir=image_directory)
+            try:
+                with zipObject.open(info) as source, os.fdopen(handle, 'wb') as target:
+                    shutil.copyfileobj(source, target, 1024*1024)
+            except Exception:
+                os.remove(part_path)
+                raise
+            os.replace(part_path, target_path)
+    return files
+
+
+def unzip_images(download_directory, image_directory, image_type, workers=4):
     """
-    Unzips images in download_directory, and extracts images of image_type to image_directory
+    Unzips images in download_directory, and extracts images of image_type to image_directory. Products downloaded
+    band by band (see download_sentinel) are found as <title>.SAFE folders instead of zip-files, and are handled the same way.
     download_directory:
     image_directory:
     image_type: string containing the type of image demanded. Can be band-8 NIR ('B08.jp2') or true color image
     ('TCI.jp2')
+    workers: integer number of zip-files extracted at the same time. Defaults to 4
+
+    Zip-files are extracted concurrently with extract_zip. A zip-file that cannot be read is reported and deleted, so
+    the product is downloaded again on the next run.
+
+    returns: dict of product title (zip filename without .zip): list of extracted image filenames
 
     Created by oew@geus.dk
     27 Jan 2021
     """
 
-    zip_files = [file for file in os.listdir(download_directory) if file[-4:] == '.zip']
-    for zip_file in zip_files:
-        filePath = os.path.join(download_directory, zip_file)
-        with ZipFile(filePath, 'r') as zipObject:
-            listOfFileNames = zipObject.namelist()
-            for fileName in listOfFileNames:
-                if fileName.endswith(image_type):
-                    zipObject.extract(fileName, download_directory)
-
-    # Move images from subdirectories to image_directory
+    extracted = {}
+    zip_files = sorted(file for file in os.listdir(download_directory) if file[-4:] == '.zip')
+    with stage('unzip', zip_files=len(zip_files)), ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(extract_zip, os.path.join(download_directory, zip_file), image_directory, image_type) for zip_file in zip_files]
+        for zip_file, future in zip(zip_files, futures):
+            try:
+                extracted[zip_file[:-4]] = future.result()
+            except (BadZipFile, OSError, EOFError, zlib.error) as e:
+                print('Failed to extract {}. Reason: {}'.format(zip_file, e))
+
+    # Move images from the folders of products downloaded band by band to image_directory
     for root, dirs, files in os.walk(download_directory):
+        product_folder = os.path.relpath(root, download_directory).split(os.sep)[0]
+        if not product_folder.endswith('.SAFE'):
+            continue
         for file in [f for f in files if f.endswith(image_type)]:
             shutil.move(os.path.join(root, file), os.path.join(image_directory, file))
+            extracted.setdefault(product_folder[:-5], []).append(file)
 
     # Delete zip-files and unzipped folders
     for file in os.listdir(download_directory):
-        if file.endswith('.zip'):
+        if file.endswith('.incomplete'):
+            continue # Partial download, which is resumed by sentinelsat on the next download
+        elif file.endswith('.zip'):
             os.remove(os.path.join(download_directory, file))
         elif file.endswith('.DS_Store'):
             os.remove(os.path.join(download_directory, file))
         else:
             shutil.rmtree(os.path.join(download_directory, file))
 
+    return extracted
+
+
+def extract_product(download_directory, title, image_directory, image_type):
+    """
+    Extracts the images of image_type of a single downloaded product to image_directory, and deletes the download. The
+    product is either the zip-file <title>.zip or, when downloaded band by band, the folder <title>.SAFE. A zip-file that
+    cannot be read is also deleted, so the product is downloaded again on the next run.
+
+    returns: list of extracted image filenames
+    """
+    zip_path = os.path.join(download_directory, title + '.zip')
+    safe_path = os.path.join(download_directory, title + '.SAFE')
+    files = []
+    if os.path.exists(zip_path):
+        try:
+            with stage('unzip', product=title):
+                files = extract_zip(zip_path, image_directory, image_type)
+        finally:
+            os.remove(zip_path)
+    if os.path.isdir(safe_path):
+        for root, dirs, filenames in os.walk(safe_path):
+            for file in [f for f in filenames if f.endswith(image_type)]:
+                shutil.move(os.path.join(root, file), os.path.join(image_directory, file))
+                files.append(file)
+        shutil.rmtree(safe_path)
+    return files
+
+
+def decimation_factor(window_width, output_width=OUTPUT_WIDTH):
+    """
+    Returns the largest power of two by which a window of window_width pixels can be decimated while still having at
+    least output_width pixels. JPEG2000 images store reduced-resolution levels at powers of two, so reading at this
+    factor only decodes the resolution level needed for the output image.
+    window_width: width of the window in full-resolution pixels
+    output_width: width of the output image in pixels. Defaults to the width of the large (LA) image
+    """
+    factor = 1
+    while window_width // (factor * 2) >= output_width:
+        factor *= 2
+    return factor
+
+
+@lru_cache(maxsize=1024)
+def tile_placement(tile_transform, tile_shape, grid_transform, grid_shape, factor):
+    """
+    Finds where a tile is placed on the output grid of a mosaic. The output grid is aligned with the full-resolution
+    pixels of the tiles, and each output pixel covers factor x factor full-resolution pixels. Output pixels only
+    partly covered by the tile are left out.
+
+    tile_transform: Affine transform of the full-resolution tile
+    tile_shape: (height, width) of the full-resolution tile
+    grid_transform: Affine transform of the output grid
+    grid_shape: (height, width) of the output grid
+    factor: integer decimation factor of the output grid
+
+    returns: (window, (row_start, row_stop, col_start, col_stop)) with the window to read from the tile, and the
+    slices of the output grid it fills. None if the tile does not overlap the output grid. Cached, as the same tiles are
+    placed on the same grid for every scene of a glacier
+    """
+    res = tile_transform.a
+    # Offset of the tile in full-resolution pixels of the output grid
+    col_offset = int(round((tile_transform.c - grid_transform.c) / res))
+    row_offset = int(round((grid_transform.f - tile_transform.f) / res))
+
+    col_start = -(-max(col_offset, 0) // factor)
+    col_stop = min(grid_shape[1], (col_offset + tile_shape[1]) // factor)
+    row_start = -(-max(row_offset, 0) // factor)
+    row_stop = min(grid_shape[0], (row_offset + tile_shape[0]) // factor)
+    if col_stop <= col_start or row_stop <= row_start:
+        return None
+
+    window = Window.from_slices((row_start*factor - row_offset, row_stop*factor - row_offset), (col_start*factor - col_offset, col_stop*factor - col_offset))
+    return window, (row_start, row_stop, col_start, col_stop)
+
+
+def mosaic_grid(tile_transform, bounds, factor):
+    """
+    Returns (grid_transform, grid_shape) of the output grid of mosaic_tiles covering bounds, with pixels of factor x
+    factor full-resolution pixels of the tile. The grid is aligned to multiples of its pixel size in the projection, so
+    the grids of all glaciers read at the same factor line up, and can be cut from one read of a tile (see
+    SharedTileReader). Tiles in the same UTM zone share the 10 m grid.
+
+    tile_transform: Affine transform of the full-resolution tile
+    bounds: (minx, miny, maxx, maxy) in the projection of the tile
+    factor: integer decimation factor, see decimation_factor
+    """
+    minx, miny, maxx, maxy = bounds
+    step = tile_transform.a * factor
+    left = np.floor(minx / step) * step
+    top = np.ceil(maxy / step) * step
+    grid_shape = (int(np.ceil((top - miny) / step)), int(np.ceil((maxx - left) / step)))
+    return Affine(step, 0, left, 0, -step, top), grid_shape
+
+
+def tile_images(image_list):
+    """
+    Returns a dict of tile: dict of band: path for the images in image_list
+    """
+    tiles = {}
+    for image in image_list:
+        record = parse_band_filename(image)
+        tiles.setdefault(record.tile, {})[record.band] = image
+    return tiles
+
+
+def mosaic_placements(image_list, bounds, factor):
+    """
+    Finds where each tile in image_list goes on the output grid of mosaic_tiles. Only the headers of the images are read.
+
+    returns: (placements, grid_transform, grid_shape, dtype)
+    placements: list of (bands, window, slices) for each tile overlapping the output grid, in the order of the tiles.
+    bands is a dict of band: path of the tile, and window and slices are as returned by tile_placement
+    dtype: data type of the bands
+    """
+    tiles = tile_images(image_list)
+    grid_transform = None
+    placements = []
+    for tile in sorted(tiles):
+        blue = image_header(tiles[tile]['B02'])
+        if grid_transform is None:
+            grid_transform, grid_shape = mosaic_grid(blue.transform, bounds, factor)
+            dtype = blue.dtype
+        placement = tile_placement(blue.transform, blue.shape, grid_transform, grid_shape, factor)
+        if placement is not None:
+            placements.append((tiles[tile],) + placement)
+    return placements, grid_transform, grid_shape, dtype
+
+
+def read_tile_window(bands, window, factor):
+    """
+    Reads window of the red, green and blue band of a tile, decimated by factor
+
+    bands: dict of band: path of the tile, e.g. {'B02': ..., 'B03': ..., 'B04': ...}
+    window: Window in full-resolution pixels, with a height and width divisible by factor
+
+    returns: array of shape (3, height // factor, width // factor)
+    """
+    out_shape = (int(window.height) // factor, int(window.width) // factor)
+    return np.stack([open_dataset(bands[band]).read(1, window=window, out_shape=out_shape) for band in ('B04', 'B03', 'B02')])
+
+
+def mosaic_tiles(image_list, bounds, factor, reader=read_tile_window):
+    """
+    Merges the windows of all tiles in image_list into one RGB array covering bounds
+
+    image_list: list of relative paths to the .jp2 images (B02, B03 and B04 band of each tile)
+    bounds: (minx, miny, maxx, maxy) in the projection of the images
+    factor: integer decimation factor, see decimation_factor
+    reader: function(bands, window, factor) returning the bands of a tile, see read_tile_window. Defaults to reading
+    the images
+
+    returns: (tci, coverage, transform)
+    tci: array of shape (3, height, width) with the red, green and blue bands
+    coverage: bool array of shape (height, width), True where a tile has data
+    transform: Affine transform of the output grid
+    """
+    placements, grid_transform, grid_shape, dtype = mosaic_placements(image_list, bounds, factor)
+    tci = np.zeros((3,) + grid_shape, dtype=dtype)
+    coverage = np.zeros(grid_shape, dtype=bool)
+
+    for tile_bands, window, (row_start, row_stop, col_start, col_stop) in placements:
+        if coverage[row_start:row_stop, col_start:col_stop].all():
+            continue # Already covered by overlapping tiles
+        # Only the window of each tile is read, to reduce memory use
+        bands = reader(tile_bands, window, factor)
+
+        # Fill the pixels where the tile has data and no earlier tile has
+        valid = bands.any(axis=0) & ~coverage[row_start:row_stop, col_start:col_stop]
+        tci[:, row_start:row_stop, col_start:col_stop][:, valid] = bands[:, valid]
+        coverage[row_start:row_stop, col_start:col_stop] |= valid
+
+    return tci, coverage, grid_transform
+
+
+def scene_window(glacier, image_list, output_width=OUTPUT_WIDTH):
+    """
+    Returns (bounds, factor, to_crs, crs) of the scene of glacier made from image_list
+    bounds: (minx, miny, maxx, maxy) of the glacier bounding box in the projection of the images
+    factor: decimation factor the bands are read at for an image of output_width pixels
+    to_crs: string with the projection of the images, e.g. 'epsg:32622'
+    crs: rasterio CRS of the images
+    """
+    header = image_header(image_list[0]) # Only the header, for the projection
+    bounds = glacier_utm_bounds(glacier, header.to_crs) # Limits in image projection, precomputed in the glacier registry
+    # Read the bands at the lowest resolution that still fills the output image
+    factor = decimation_factor((bounds[2]-bounds[0]) / header.res[0], output_width)
+    return bounds, factor, header.to_crs, header.crs
+
 
-def make_image(glacier, n, image_list, output_directory, date):
+class SharedTileReader:
+    """
+    Reader for mosaic_tiles that reads each tile once for a group of scenes from the same acquisition, e.g. the scenes
+    of glaciers sharing a tile. The bands of each tile are read over the union of the windows of all scenes in the
+    group, and the window of each scene is cut from that read. Memory use is bounded by the size of the union windows.
+
+    Windows of scenes read at the same factor line up on the decimated grid (see mosaic_grid), so the cut windows hold
+    the same values as separate reads.
+    """
+
+    def __init__(self, group):
+        """
+        group: list of (glacier, date, image_list) scenes, as returned by glacier_scenes
+        """
+        self.unions = {} # (B02 path, factor): union Window
+        self.bands = {} # (B02 path, factor): array of the union window
+        for glacier, date, image_list in group:
+            bounds, factor = scene_window(glacier, image_list)[:2]
+            for tile_bands, window, slices in mosaic_placements(image_list, bounds, factor)[0]:
+                key = (tile_bands['B02'], factor)
+                self.unions[key] = union(self.unions[key], window) if key in self.unions else window
+
+    def __call__(self, tile_bands, window, factor):
+        key = (tile_bands['B02'], factor)
+        if key not in self.unions: # Not part of the group
+            return read_tile_window(tile_bands, window, factor)
+        union_window = self.unions[key]
+        if key not in self.bands:
+            with stage('shared_read', factor=factor):
+                self.bands[key] = read_tile_window(tile_bands, union_window, factor)
+        row = int(window.row_off - union_window.row_off) // factor
+        col = int(window.col_off - union_window.col_off) // factor
+        return self.bands[key][:, row:row + int(window.height) // factor, col:col + int(window.width) // factor]
+
+
+def scene_mosaic(glacier, image_list, bounds, factor, crs, cutout_directory=None, reader=read_tile_window):
+    """
+    Returns mosaic_tiles(image_list, bounds, factor, reader). With cutout_directory, the mosaic is read from the cutout
+    of the scene if it is in the cutout store, and otherwise written to it (see sentinelsat_cutouts.py)
+
+    crs: projection of the images, stored with the cutout
+    """
+    if cutout_directory is None:
+        return mosaic_tiles(image_list, bounds, factor, reader)
+    path = cutout_path(cutout_directory, glacier, parse_band_filename(image_list[0]).datetime)
+    key = cutout_key(image_list, bounds, factor)
+    mosaic = read_cutout(path, key)
+    if mosaic is None:
+        mosaic = mosaic_tiles(image_list, bounds, factor, reader)
+        with stage('write_cutout'):
+            write_cutout(path, key, *mosaic, crs)
+    return mosaic
+
+
+@lru_cache(maxsize=None)
+def root_lookup_table(n, dtype=np.uint16):
+    """
+    Returns a float32 lookup table with the n'th root of every value of the integer dtype, so lut[band] == band**(1/n)
+    n: integer (1-10) for RGB composition
+    dtype: integer numpy dtype of the bands. Defaults to uint16 (Sentinel-2 L1C)
+    """
+    return np.arange(np.iinfo(dtype).max + 1, dtype=np.float32) ** np.float32(1/n)
+
+
+def scene_rgba(glacier, n, image_list, cutout_directory=None, reader=read_tile_window):
+    """
+    Reads the images in image_list and makes the normalized RGB composite of glacier
+
+    Glacier: string containing glacier name
+    n: integer (1-10) for RGB composition. band = band^(1/n)
+    image_list: list of relative paths to .jp2 images
+    cutout_directory: string containing the directory of the cutout store, see scene_mosaic. Defaults to None (always decode the images)
+    reader: function reading the bands of each tile, see mosaic_tiles
+
+    returns: (rgba, transform, bounds, to_crs)
+    rgba: float32 array of shape (height, width, 4) with the bands in [0,1], and alpha 0 where no tile has data
+    transform: Affine transform of rgba
+    bounds: (minx, miny, maxx, maxy) of the glacier bounding box in the projection of the images
+    to_crs: string with the projection of the images, e.g. 'epsg:32622'
+    """
+    #%% Get projection and extent of image, and the resolution to read the bands at
+    (minx, miny, maxx, maxy), factor, to_crs, crs = scene_window(glacier, image_list)
+
+    #%% Merge the tiles into one array on the output grid
+    with stage('decode', factor=factor):
+        tci, coverage, mosaic_transform = scene_mosaic(glacier, image_list, (minx, miny, maxx, maxy), factor, crs, cutout_directory, reader)
+
+    # Normalization uses min and max of the whole scene, over all tiles. Pixels without data are left out.
+    # The n'th root is monotonic, so the limits can be found on the integer bands
+    with stage('normalize'):
+        lut = root_lookup_table(n, tci.dtype)
+        if coverage.any():
+            norm_min = lut[tci.min(where=coverage, initial=np.iinfo(tci.dtype).max)]
+            norm_max = lut[tci.max(where=coverage, initial=0)]
+        else:
+            norm_min = norm_max = 0
+
+        # Take the n'th root of each band with the lookup table, and shift and stretch bands to be in [0,1].
+        # Done band by band in place in the float32 output, so no full float64 copies of the scene are made
+        rgba = np.empty(tci.shape[1:] + (4,), dtype=np.float32)
+        for band in range(3):
+            np.take(lut, tci[band], out=rgba[..., band], mode='clip')
+            rgba[..., band] -= norm_min
+            if norm_max != 0:
+                rgba[..., band] /= norm_max
+        rgba[~coverage, :3] = 0 # Pixels without data would be below 0 after the shift
+        rgba[..., 3] = coverage
+
+    return rgba, mosaic_transform, (minx, miny, maxx, maxy), to_crs
+
+
+def scene_quality(glacier, image_list, sample_width=QUALITY_SAMPLE_WIDTH, bright_value=BRIGHT_VALUE):
+    """
+    Returns the quality of the scene of glacier made from image_list, from the window of the glacier read at low
+    resolution. This only decodes a coarse resolution level of the JPEG2000 images, so it is much cheaper than
+    make_image.
+
+    Bright pixels are counted as cloud. With only the visible bands this cannot tell clouds from snow and ice, so
+    bright_value is set above the reflectance of most glacier surfaces.
+
+    returns: dict with keys
+    'nodata': fraction of the window without data
+    'bright': fraction of the pixels with data that are bright in all three bands
+    'score': fraction of the window with data that is not bright, (1 - nodata) * (1 - bright)
+    """
+    bounds, factor = scene_window(glacier, image_list, sample_width)[:2]
+    tci, coverage, transform = mosaic_tiles(image_list, bounds, factor)
+    covered = int(coverage.sum())
+    nodata = 1 - covered / coverage.size
+    bright = int((coverage & (tci.min(axis=0) >= bright_value)).sum()) / covered if covered else 0.0
+    return {'nodata': round(nodata, 4), 'bright': round(bright, 4), 'score': round((1 - nodata) * (1 - bright), 4)}
+
+
+def select_scenes(scenes, image_directory, min_quality, force=False):
+    """
+    Leaves out the scenes whose quality stored in the scene catalog (see sentinelsat_catalog.py) is below min_quality.
+    Scenes without a stored quality are kept, and checked by render_scenes.
+    force: bool to keep all scenes, so their quality is checked again by render_scenes (e.g. after the threshold or
+    scene_quality changed)
+
+    returns: list of the remaining scenes
+    """
+    if min_quality is None or force:
+        return list(scenes)
+    cached = cached_quality(image_directory, scenes)
+    selected = [scene for scene in scenes if (scene[0], scene[1]) not in cached or cached[(scene[0], scene[1])]['score'] >= min_quality]
+    if len(selected) < len(scenes):
+        print('Skipped {} scenes with quality below {} in earlier runs'.format(len(scenes) - len(selected), min_quality))
+    return selected
+
+
+def make_image(glacier, n, image_list, output_directory, date, engine='matplotlib', cutout_directory=None, reader=read_tile_window):
     """
     Makes the image of glacier, using the images in image_list, bounded in the appropriate UTM coordinates by minx, maxx, miny and maxy. Writes date in the bottom, and adds a 10km scalebar.
 
@@ -82,65 +485,52 @@ def make_image(glacier, n, image_list, output_directory, date):
     n: integer (1-10) for RGB composition. band = band^(1/n)
     image_list: list of relative paths to .jp2 images
     date: str formatted  "YYYYMMDDTHHMMSS". ex "20200115T230203"
+    engine: string with the rendering engine. 'matplotlib' (default) draws a matplotlib figure, 'pil' draws directly
+    into pixel buffers with the faster engine in sentinelsat_render.py
+    cutout_directory: string containing the directory of the cutout store (see sentinelsat_cutouts.py). Defaults to None (no store)
+    reader: function reading the bands of each tile, see mosaic_tiles. Defaults to reading the images
+
+    returns: list of the paths of the large and small png files
 
     Created by oew@geus.dk
     27 Jan 2021
 
     """
 
-    
+    rgba, mosaic_transform, (minx, miny, maxx, maxy), to_crs = scene_rgba(glacier, n, image_list, cutout_directory, reader)
+
+    outlet_number = glacier_definitions(glacier, 'outlet_number')
+    filename = '{}/Outlet_{}_LA_DK_{}'.format(output_directory, outlet_number, date[:8])
+    filename_SM = '{}/Outlet_{}_SM_DK_{}'.format(output_directory, outlet_number, date[:8])
+
+    if engine not in ('matplotlib', 'pil'):
+        raise ValueError('Unknown rendering engine {}'.format(engine))
+
+    #%% Reproject ice extents
+    # Only the part of the outline inside the image is plotted. Reprojection is cached per projection (sentinelsat_layers.py)
+    with stage('reproject'):
+        cfl1980 = clipped_outline(to_crs, (minx, miny, maxx, maxy))
 
-    #%% Get projection and extent of image
-    crs_image = rasterio.open(image_list[0]) # Loaded just for crs
-    to_crs = crs_image.crs.data["init"] # Get the projection and use for bounds
+    if engine == 'pil':
+        with stage('render', engine=engine):
+            render_image(glacier, date, rgba, mosaic_transform, (minx, miny, maxx, maxy), cfl1980, filename, filename_SM, OUTPUT_WIDTH)
+        return [filename + '.png', filename_SM + '.png']
 
-    transformer = Transformer.from_crs("epsg:4326", to_crs) # Function to transform lat-lon limits to appropriate projection
-    bounding_box = glacier_definitions(glacier, 'bounding_box')
-    minx, miny = transformer.transform(bounding_box[1], bounding_box[0]) # Transform limits to image projection
-    maxx, maxy = transformer.transform(bounding_box[3], bounding_box[2]) # Transform limits to image projection
     h_pixels = maxy-miny
     w_pixels = maxx-minx
     aspect_ratio = h_pixels/w_pixels
     plt.rcParams['figure.dpi'] = 300
     px = 1/plt.rcParams['figure.dpi']
 
-    fig, ax = plt.subplots(figsize=(2280*px, 2280*aspect_ratio*px))
-    #%% Plot each tile individually.
-    tiles = list(set([i[-30:-24] for i in image_list]))
-    for i, tile in enumerate(tiles):
-        # Get images for this specific tile
-        tile_image_list = [i for i in image_list if i[-30:-24].endswith(tile)]
-        tile_image_list.sort()
-
-        # Get the appropriate color bands
-        blue = rasterio.open(tile_image_list[0], 'r')
-        green = rasterio.open(tile_image_list[1], 'r')
-        red = rasterio.open(tile_image_list[2], 'r')
-
-        # Make a window to reduce memory use. This way only the relevant part of each tile is read.
-        minrow, mincol = TransformMethodsMixin.index(blue, minx, maxy)
-        maxrow, maxcol = TransformMethodsMixin.index(blue, maxx, miny)
-        window = Window.from_slices((max(0, minrow), max(0, maxrow)), (max(0, mincol), max(0, maxcol)))
-
-        # Take the n'th root of each band
-        tci = np.vstack((red.read(window=window), green.read(window=window), blue.read(window=window)))**(1/n)
-        # Make sure normalization is the same for all tiles in scene
-        if i == 0:
-            norm_min = tci.min(axis=(0,1,2), keepdims=True) # axis=(0,1,2) uses min and max of whole image
-            norm_max = tci.max(axis=(0,1,2), keepdims=True) # axis=(1,2) normalizes each channel independently
-        # Shift and stretch bands to be in [0,1]
-        tci = tci - norm_min
-        if norm_max != 0:
-            tci = tci/norm_max
-
-        # Plot with rasterio, using the transform of the raster
-        rasterio.plot.show(tci, transform=blue.window_transform(window), ax=ax)
-
-    #%% Reproject and ice extents
-    cflPath1980 = './prom_total_man_corr_v2b.shp'
-    cfl1980 = geopandas.read_file(cflPath1980)
-    cfl1980 = cfl1980.to_crs(to_crs)
-    cfl1980.boundary.plot(ax=ax, color='red', alpha=1, linewidth=1, label='1980')
+    fig, ax = plt.subplots(figsize=(OUTPUT_WIDTH*px, OUTPUT_WIDTH*aspect_ratio*px))
+
+    # Plot once, transparent where no tile has data
+    ax.imshow(rgba, extent=rasterio.plot.plotting_extent(rgba, mosaic_transform))
+
+    #%% Plot ice extents
+    if not cfl1980.empty:
+        cfl1980.plot(ax=ax, color='red', alpha=1, linewidth=1)
+    ax.plot([], [], color='red', alpha=1, linewidth=1, label='1980') # Legend entry, also when no outline is inside the image
 
     # cflPath2000 = './cfl/gimp_total_diss_id_v2.shp'
     # cfl2000 = geopandas.read_file(cflPath2000)
@@ -168,19 +558,209 @@ def make_image(glacier, n, image_list, output_directory, date):
     date_plot.set_bbox(dict(facecolor='white', alpha=0.8))
 
     # Save figure (2 sizes) and close to clear memory
-    outlet_number = glacier_definitions(glacier, 'outlet_number')
-    filename = '{}/Outlet_{}_LA_DK_{}'.format(output_directory, outlet_number, date[:8])
-    filename_SM = '{}/Outlet_{}_SM_DK_{}'.format(output_directory, outlet_number, date[:8])
     #fig.savefig(filename, dpi=300, bbox_inches='tight', pad_inches=0)
     fig.tight_layout(pad=0)
-    fig.savefig(filename_SM, dpi=100)
-    fig.savefig(filename, dpi=300)
+    with stage('savefig', engine=engine): # Most of the drawing is done here, as matplotlib draws when saving
+        fig.savefig(filename_SM, dpi=100)
+        fig.savefig(filename, dpi=300)
     plt.close()
 
-    del ax, fig, tci # Clear some memory. Not sure if necessary, but it solved run issues on my computer
+    del ax, fig, rgba # Clear some memory. Not sure if necessary, but it solved run issues on my computer
+    return [filename + '.png', filename_SM + '.png']
+
+
+def glacier_scenes(glacier, unprocessed_image_directory, index=None):
+    """
+    Groups the images in unprocessed_image_directory into scenes for glacier
+
+    glacier: string containing glacier name as defined in sentinelsat_glacier_definitions.py
+    unprocessed_image_directory: string containing the directory where the extracted tile-size Sentinel images are placed
+    index: dict of (tile, datetime): dict of band: BandRecord, as returned by index_scenes. Defaults to None (index the
+    catalog of unprocessed_image_directory, see sentinelsat_catalog.py)
+
+    returns: list of (glacier, date, image_list) tuples, one for each set of images from the same timestamp covering
+    the tiles of glacier. date is str formatted "YYYYMMDDTHHMMSS"
+    """
+    if index is None:
+        index = index_scenes(load_catalog(unprocessed_image_directory))
+
+    # Tiles covering this glacier
+    tiles = glacier_definitions(glacier, 'tile_relorb_dict')
+
+    image_lists = {}
+    for (tile, date), bands in index.items():
+        if tile in tiles:
+            image_lists.setdefault(date, []).extend(os.path.join(unprocessed_image_directory, record.filename) for record in sorted(bands.values()))
+    return [(glacier, date, image_lists[date]) for date in sorted(image_lists)]
+
+
+def resolve_date(date, today=None):
+    """
+    Returns a date of the queries as a string formatted 'YYYYMMDD', so it can be compared with the dates of the scenes
+    date: string formatted 'YYYYMMDD' or 'NOW' or 'NOW-kDAYS', 'NOW-kMONTHS' or 'NOW-kYEARS' where k is integer
+    today: datetime used for 'NOW'. Defaults to None (the current date)
+    """
+    match = RELATIVE_DATE.match(date)
+    if match is None:
+        return datetime.strptime(date, '%Y%m%d').strftime('%Y%m%d')
+    today = today or datetime.now()
+    if match.group('count') is None:
+        return today.strftime('%Y%m%d')
+    delta = relativedelta(**{match.group('unit').lower() + 's': int(match.group('count'))})
+    return (today - delta).strftime('%Y%m%d')
+
+
+def scenes_in_range(scenes, from_date, to_date):
+    """
+    Returns the scenes sensed from from_date to to_date, both included
+    scenes: list of (glacier, date, image_list) tuples, as returned by glacier_scenes
+    from_date, to_date: see resolve_date
+    """
+    first, last = resolve_date(from_date), resolve_date(to_date)
+    return [scene for scene in scenes if first <= scene[1][:8] <= last]
+
+
+def init_render_worker():
+    """
+    Initializer for the render worker processes of render_scenes and of the streaming pipeline. Selects the
+    non-interactive Agg backend, so figures can be made without a display and without the GUI event loop of the parent
+    process. Also clears the stage records and open datasets inherited from the parent process (see
+    sentinelsat_instrumentation.py and sentinelsat_datasets.py).
+    """
+    plt.switch_backend('Agg')
+    reset_records()
+    close_datasets()
+
+
+def _render_scene(scene, n, processed_image_directory, engine, min_quality=None, cutout_directory=None, reader=read_tile_window):
+    """
+    Calls make_image for a single (glacier, date, image_list) scene and catches any error, so that a single corrupt
+    image does not stop the processing of the remaining scenes. With min_quality, the scene is first checked with
+    scene_quality, and skipped if its score is below min_quality.
+
+    returns: dict with keys 'glacier', 'date', 'success', 'error' (None if successful), 'files' (paths of the png
+    files, empty if not successful or skipped), 'skipped' and 'quality' (None if not checked)
+    """
+    glacier, date, image_list = scene
+    quality = None
+    try:
+        with stage('scene', glacier=glacier, date=date, engine=engine) as fields:
+            if min_quality is not None:
+                with stage('quality'):
+                    quality = scene_quality(glacier, image_list)
+                fields['score'] = quality['score']
+                if quality['score'] < min_quality:
+                    return {'glacier': glacier, 'date': date, 'success': True, 'error': None, 'files': [], 'skipped': True, 'quality': quality}
+            files = make_image(glacier, n, image_list, processed_image_directory, date, engine, cutout_directory, reader)
+    except Exception as e:
+        plt.close('all')
+        return {'glacier': glacier, 'date': date, 'success': False, 'error': '{}: {}'.format(type(e).__name__, e), 'files': [], 'skipped': False, 'quality': quality}
+    return {'glacier': glacier, 'date': date, 'success': True, 'error': None, 'files': files, 'skipped': False, 'quality': quality}
+
+
+def scene_groups(scenes):
+    """
+    Groups the scenes of the same date whose glaciers share a tile, in the order of scenes. Scenes from the same date
+    are from the same acquisition, so the scenes of a group can be made from one read of each tile (see
+    SharedTileReader). Scenes sharing no tile with other scenes are in a group of their own.
+
+    returns: list of lists of scenes
+    """
+    groups = [] # List of (tiles, indices of the scenes), with the tiles as a set of (date, tile)
+    for i, scene in enumerate(scenes):
+        tiles = set((scene[1], parse_band_filename(image).tile) for image in scene[2])
+        indices = [i]
+        for group in [group for group in groups if group[0] & tiles]:
+            groups.remove(group)
+            tiles |= group[0]
+            indices += group[1]
+        groups.append((tiles, sorted(indices)))
+    return [[scenes[i] for i in indices] for tiles, indices in sorted(groups, key=lambda group: group[1][0])]
+
+
+def _render_group(group, n, processed_image_directory, engine, min_quality=None, cutout_directory=None):
+    """
+    Calls _render_scene for each scene in group. The scenes of a group of more than one scene read their tiles through
+    a SharedTileReader. The number of datasets opened and reused from the pool of open datasets (see
+    sentinelsat_datasets.py) are added to the 'group' stage record.
 
+    returns: list of dicts as returned by _render_scene, in the order of group
+    """
+    with stage('group', scenes=len(group)) as fields:
+        before = dataset_stats()
+        reader = read_tile_window
+        if len(group) > 1:
+            try:
+                with stage('plan'):
+                    reader = SharedTileReader(group)
+            except Exception as e: # E.g. a corrupt image, which is then reported for the scenes using it
+                print('Failed to plan shared reads for {}. Reason: {}'.format(group[0][1], e))
+        results = [_render_scene(scene, n, processed_image_directory, engine, min_quality, cutout_directory, reader) for scene in group]
+        after = dataset_stats()
+        fields.update({'datasets_opened': after['opened'] - before['opened'], 'datasets_reused': after['reused'] - before['reused'], 'datasets_open': after['open']})
+    return results
+
+
+def render_group_worker(group, n, processed_image_directory, engine, min_quality=None, cutout_directory=None):
+    """
+    Makes the images of a group of scenes in a render worker process (see init_render_worker). Returns (results,
+    stages), with the results of _render_group and the stage records of the group, so they can be added to the records
+    of the main process.
+    """
+    results = _render_group(group, n, processed_image_directory, engine, min_quality, cutout_directory)
+    return results, drain_records()
 
-def sentinel_process(glacier, from_date, to_date, download_directory, unprocessed_image_directory, processed_image_directory, image_type, n, max_cloud_percentage, download=True):
+
+def render_scenes(scenes, n, processed_image_directory, workers=1, engine='matplotlib', min_quality=None, cutout_directory=None, shared_reads=False):
+    """
+    Makes the images for a list of scenes, optionally spread across a pool of worker processes
+
+    scenes: list of (glacier, date, image_list) tuples, as returned by glacier_scenes
+    n: integer (1-10) for RGB composition. band = band^(1/n)
+    processed_image_directory: string containing the directory where the processed calving front region images will be placed
+    workers: integer number of worker processes. With workers=1 the scenes are processed one at a time in this process.
+    engine: string with the rendering engine used by make_image, 'matplotlib' or 'pil'
+    min_quality: minimum score (0-1) of scene_quality for a scene to be rendered. Defaults to None (no check)
+    cutout_directory: string containing the directory of the cutout store used by make_image. Defaults to None (no store)
+    shared_reads: bool to make the scenes of the same date whose glaciers share a tile together, reading the tile once
+    for all of them (see scene_groups and SharedTileReader). Each group of scenes is made by one worker process.
+    Defaults to False
+
+    returns: list of dicts with keys 'glacier', 'date', 'success', 'error', 'files', 'skipped' and 'quality', one for each scene, in the order of scenes
+    """
+    groups = scene_groups(scenes) if shared_reads else [[scene] for scene in scenes]
+    if workers <= 1 or len(groups) <= 1:
+        return [result for group in groups for result in _render_group(group, n, processed_image_directory, engine, min_quality, cutout_directory)]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_render_worker) as executor:
+        futures = [executor.submit(render_group_worker, group, n, processed_image_directory, engine, min_quality, cutout_directory) for group in groups]
+        results = {}
+        for group, future in zip(groups, futures):
+            try:
+                group_results, stages = future.result()
+                add_records(stages)
+            except Exception as e: # E.g. a worker process killed by running out of memory
+                group_results = [{'glacier': scene[0], 'date': scene[1], 'success': False, 'error': '{}: {}'.format(type(e).__name__, e), 'files': [], 'skipped': False, 'quality': None} for scene in group]
+            for scene, result in zip(group, group_results):
+                results[(scene[0], scene[1])] = result
+    return [results[(scene[0], scene[1])] for scene in scenes]
+
+
+def report_render_results(results):
+    """
+    Prints the number of successfully processed scenes, and the error of each failed scene
+    results: list of dicts as returned by render_scenes
+    """
+    failed = [r for r in results if not r['success']]
+    skipped = [r for r in results if r.get('skipped')]
+    print('Processed {} of {} scenes'.format(len(results) - len(failed) - len(skipped), len(results)))
+    if skipped:
+        print('Skipped {} scenes below the quality threshold: {}'.format(len(skipped), ', '.join('{} {} ({:.2f})'.format(r['glacier'], r['date'], r['quality']['score']) for r in skipped)))
+    for r in failed:
+        print('Failed to process {} {}. Reason: {}'.format(r['glacier'], r['date'], r['error']))
+
+
+def sentinel_process(glacier, from_date, to_date, download_directory, unprocessed_image_directory, processed_image_directory, image_type, n, max_cloud_percentage, download=True, workers=1, max_store_bytes=None, band_fetch=False, ledger_path=LEDGER_PATH, force=False, engine='matplotlib', min_quality=None, cutout_directory=None):
     """
     Function to download, unzip and process the downloaded Sentinel images into calving front area cutouts with overlay for the glacier
 
@@ -191,9 +771,21 @@ def sentinel_process(glacier, from_date, to_date, download_directory, unprocesse
     unprocessed_image_directory: string containing the directory where the extracted tile-size Sentinel images will be placed
     processed_image_directory: string containing the directory where the processed calving front region images will be placed
     image_type: string containing the used band in the Sentinel download. Can be bands 'B01' through 'B12' or 'TCI' (true-color image)
-    download: bool to control whether or not the images should be downloaded. If downloaded, all images in the directory unprocessed_image_directory will be deleted. Allows for code development of image processing with already downloaded images, without having to download again. Defaults to True.
+    download: bool to control whether or not the images should be downloaded. Only products not already extracted to unprocessed_image_directory are downloaded. Allows for code development of image processing with already downloaded images, without having to download again. Defaults to True.
+    workers: integer number of processes used to make the images. Defaults to 1 (no parallel processing)
+    band_fetch: bool to download only the image_type band files of each product instead of the full zip-files. Defaults to False
+    ledger_path: string containing the path of the processing ledger. Scenes already processed with the same input images and parameters are skipped (see sentinelsat_ledger.py)
+    force: bool to process all scenes, also those already in the ledger. Defaults to False
+    engine: string with the rendering engine used by make_image, 'matplotlib' (default) or 'pil'
+    min_quality: minimum score (0-1) of scene_quality for a scene to be rendered, i.e. the fraction of the glacier window with data and without cloud. The score is stored in the scene catalog, so poor scenes are not read again in later runs. Defaults to None (no check)
+    cutout_directory: string containing the directory where the merged window of each scene is kept, so images can be made again without decoding the tiles (see sentinelsat_cutouts.py). Defaults to None (no store)
+    max_store_bytes: integer maximum size of the extracted images kept in unprocessed_image_directory. The images of the least recently used products are deleted when exceeded. Defaults to None (no limit)
+
+    The time and peak memory of each stage are recorded (see sentinelsat_instrumentation.py), and a summary of the stages is printed at the end.
+
+    returns: list of dicts with keys 'glacier', 'date', 'success' and 'error', one for each processed scene
 
-    BE AWARE: everything in the unprocessed_image_directory and download_directory will be routinely deleted, and cannot be recovered to my knowledge.
+    BE AWARE: zip-files and folders in download_directory will be routinely deleted, and cannot be recovered to my knowledge. Images in unprocessed_image_directory are deleted when the store exceeds max_store_bytes.
 
     Created by oew@geus.dk
     3 Feb 2021
@@ -201,90 +793,197 @@ def sentinel_process(glacier, from_date, to_date, download_directory, unprocesse
 
     """
 
-    if download: # Makes it possible to process without downloading
-        download_sentinel(glacier, from_date, to_date, download_directory, max_cloud_percentage)
+    # Stages inside prepare (query, download, unzip) are labelled with the glacier (see sentinelsat_instrumentation.py)
+    with stage('prepare', glacier=glacier):
+        products = None
+        if download: # Makes it possible to process without downloading
+            products = download_sentinel(glacier, from_date, to_date, download_directory, max_cloud_percentage, unprocessed_image_directory, image_type if band_fetch else None)
 
-    ## Unzip downloaded files, get image, delete the rest of the sentinel zip-contents
-    unzip_images(download_directory, unprocessed_image_directory, image_type)
+        ## Unzip downloaded files, get image, delete the rest of the sentinel zip-contents
+        extracted = unzip_images(download_directory, unprocessed_image_directory, image_type)
+        register_products(unprocessed_image_directory, extracted, products)
 
     ## Make image from each set of tiles from same time
-    # Get all image files
-    imageList = [i for i in os.listdir(unprocessed_image_directory) if i.endswith('jp2')] 
-
-    # Get all unique dates by transforming list to set
-    uniqueDates = set([i[7:22] for i in imageList]) 
     print('Processing images for {}'.format(glacier))
-
-    # Run the function for each set of images from same glacier with the same timestamp
-    for uniqueDate in uniqueDates: 
-        # Get list of all images
-        image_list_all = [os.path.join(unprocessed_image_directory, image) for image in imageList if image[7:22] == uniqueDate] 
-        # Get relative orbits for this glacier
-        relorbs = glacier_definitions(glacier, 'tile_relorb_dict')
-        relorbsList = list(relorbs)
-        image_list = []
-        # Make list of images for this glacier
-        for relorbi in relorbsList:
-            image_list += [i for i in image_list_all if i.startswith('{}/T{}'.format(unprocessed_image_directory, relorbi))]
-        if image_list:
-            make_image(glacier, n, image_list, processed_image_directory, uniqueDate)
+    scenes = pending_scenes(glacier_scenes(glacier, unprocessed_image_directory), n, ledger_path, force, engine=engine)
+    scenes = select_scenes(scenes, unprocessed_image_directory, min_quality, force)
+    touch_files(unprocessed_image_directory, [f for scene in scenes for f in scene[2]])
+    results = render_scenes(scenes, n, processed_image_directory, workers, engine, min_quality, cutout_directory)
+    record_quality(unprocessed_image_directory, scenes, results)
+    record_scenes(scenes, results, n, ledger_path, engine)
+    report_render_results(results)
+    if max_store_bytes is not None:
+        evict_products(unprocessed_image_directory, max_store_bytes)
+    report_summary()
     print('Finished processing images for {}'.format(glacier))
+    return results
 
 
-def download_sentinel(glacier, from_date, to_date, download_directory, max_cloud_percentage):
+def connect_api():
     """
-    Downloads Sentinel 2 images from glacier during from_date to to_date to download_directory
-    glacier: string containing the glacier name
-    from_date: string formatted 'YYYYMMDD' or 'NOW' or 'NOW-kDAYS' where k is integer
-    to_date: same as above
-    unprocessed_image_directory: string containing the directory of unprocessed images (for clearing it)
-    download_directory: string containing the target directory to place downloads.
-    max_cloud_percentage: integer
-
-    Created by oew@geus.dk
-    27 Jan 2021
-
+    Returns a SentinelAPI connected to the Copernicus SciHub, using the credentials stored as line 1 and 2 in
+    ../username_password.txt
     """
-
     # User credentials to the Copernicus SciHub
     with open('../username_password.txt', 'r') as file:
         data = file.readlines()
         data = [d.replace('\n', '') for d in data]
     USERNAME = data[0]
     PASSWORD = data[1]
-    api = SentinelAPI(USERNAME, PASSWORD, 'https://apihub.copernicus.eu/apihub/')
-    print('Downloading images for {}'.format(glacier))
-    delete_everything_in_directory(download_directory)
-    #delete_everything_in_directory(unprocessed_image_directory)
+    return SentinelAPI(USERNAME, PASSWORD, 'https://apihub.copernicus.eu/apihub/')
+
+
+def band_node_filter(image_type):
+    """
+    Returns a nodefilter for SentinelAPI.download_all, which selects only the files of image_type in each product.
+    The L1C band images carry their own georeferencing (GML-JP2), and sentinelsat always fetches the product
+    manifest.safe, so no other files are needed.
+    image_type: string or tuple of strings with the endings of the files to download, e.g. ('B02.jp2', 'B03.jp2', 'B04.jp2')
+    """
+    def node_filter(node_info):
+        return node_info['node_path'].endswith(image_type)
+    return node_filter
+
+
+def _footprint_area(properties):
+    """
+    Returns the area (in square degrees) of the footprint of a product, or 0 if the query did not return it
+    """
+    try:
+        return wkt.loads(properties['footprint']).area
+    except Exception:
+        return 0.0
 
+
+def deduplicate_products(products):
+    """
+    Keeps one product of each acquisition (tile and sensing time). An acquisition is returned more than once when it
+    has been processed again with a newer baseline (e.g. N0209 and N0500), or when it is in the tiles of more than one
+    relative orbit. The products are ranked by the newest processing baseline, then the largest footprint (best
+    coverage of the tile), then the newest generation time, using only the properties returned by the query.
+    products: OrderedDict of product id: product properties, as returned by SentinelAPI.query
+
+    returns: (OrderedDict of product id: product properties of the kept products, list of (title of the skipped
+    product, title of the product kept instead))
+    """
+    best = {}
+    for uuid, properties in products.items():
+        key = product_key(properties['title'])
+        if key is None:
+            best[uuid] = (uuid, ())
+            continue
+        rank = (key[2], _footprint_area(properties), properties['title'].split('_')[6])
+        if key[:2] not in best or rank > best[key[:2]][1]:
+            best[key[:2]] = (uuid, rank)
+    kept_ids = set(uuid for uuid, rank in best.values())
+    kept = OrderedDict((uuid, properties) for uuid, properties in products.items() if uuid in kept_ids)
+    duplicates = []
+    for uuid, properties in products.items():
+        if uuid not in kept_ids:
+            key = product_key(properties['title'])
+            duplicates.append((properties['title'], products[best[key[:2]][0]]['title']))
+    return kept, duplicates
+
+
+def query_products(glacier, from_date, to_date, max_cloud_percentage, api):
+    """
+    Queries the Sentinel 2 products of glacier during from_date to to_date. All tiles of the glacier are queried in a
+    single request, and the relative orbits are filtered from the returned products.
+    glacier: string containing the glacier name
+    from_date: string formatted 'YYYYMMDD' or 'NOW' or 'NOW-kDAYS' where k is integer
+    to_date: same as above
+    max_cloud_percentage: integer
+    api: SentinelAPI (or a stand-in with the same query method) to use
+
+    returns: OrderedDict of product id: product properties, with one product of each acquisition (see
+    deduplicate_products)
+    """
     # Dictionary containing Sentinel-2 Level1C Tile ID and relative orbit number(s)
     tile_relorb_dict = glacier_definitions(glacier, 'tile_relorb_dict')
 
-    # Specify attributes
+    # Specify attributes. A set of tile IDs is combined with OR in the query
     query_kwargs = {
                     'platformname': 'Sentinel-2',
                     'producttype': 'S2MSI1C',
-                    'date': (from_date, to_date), 
-                    'cloudcoverpercentage': (0, max_cloud_percentage)
+                    'date': (from_date, to_date),
+                    'cloudcoverpercentage': (0, max_cloud_percentage),
+                    'tileid': set(tile_relorb_dict),
     }
+    with stage('query', glacier=glacier) as fields:
+        pp = api.query(**query_kwargs)
+        fields['products'] = len(pp)
 
-    num_products = 0
     products = OrderedDict()
-    for tile, rel_orbit in tile_relorb_dict.items():
-        for orb in rel_orbit:
-            kw = query_kwargs.copy()
-            kw['tileid'] = tile
-            kw['relativeorbitnumber'] = orb
-            pp = api.query(**kw)
-            products.update(pp)
-            num_products += api.count(**kw)
-
-    path_filter = make_path_filter("*_B0[234].jp2")
+    for uuid, properties in pp.items():
+        tile = properties.get('tileid') or properties['title'].split('_')[5][1:] # Older products have no tileid
+        if int(properties['relativeorbitnumber']) in tile_relorb_dict.get(tile, []):
+            products[uuid] = properties
+
+    with stage('deduplicate', glacier=glacier) as fields:
+        products, duplicates = deduplicate_products(products)
+        fields['skipped'] = len(duplicates)
+    for title, kept_title in duplicates:
+        print('Skipping duplicate product {} of {} (keeping {})'.format(title, glacier, kept_title))
+    return products
+
+
+def query_glaciers(glacier_list, from_date, to_date, max_cloud_percentage, workers=4, api=None):
+    """
+    Queries the Sentinel 2 products of each glacier in glacier_list concurrently, with at most workers requests at a time
+    api: SentinelAPI (or a stand-in with the same query method) to use. Defaults to None (connect with connect_api)
+
+    returns: dict of glacier: OrderedDict of product id: product properties
+    """
+    if api is None:
+        api = connect_api()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(query_products, glacier, from_date, to_date, max_cloud_percentage, api) for glacier in glacier_list]
+        return {glacier: future.result() for glacier, future in zip(glacier_list, futures)}
+
+
+def download_sentinel(glacier, from_date, to_date, download_directory, max_cloud_percentage, unprocessed_image_directory=None, image_type=None, api=None, products=None):
+    """
+    Downloads Sentinel 2 images from glacier during from_date to to_date to download_directory
+    glacier: string containing the glacier name
+    from_date: string formatted 'YYYYMMDD' or 'NOW' or 'NOW-kDAYS' where k is integer
+    to_date: same as above
+    download_directory: string containing the target directory to place downloads.
+    max_cloud_percentage: integer
+    unprocessed_image_directory: string containing the directory of unprocessed images. Products already extracted to this directory (see sentinelsat_product_store.py) are not downloaded again. Defaults to None (download all products)
+    image_type: string or tuple of strings with the endings of the band files to download, e.g. ('B02.jp2', 'B03.jp2', 'B04.jp2'). Only these files are downloaded, into a <title>.SAFE folder for each product, instead of the full zip-file. Defaults to None (download full zip-files)
+    api: SentinelAPI (or a stand-in with the same query and download_all methods) to use. Defaults to None (connect with connect_api)
+    products: OrderedDict of product id: product properties already queried for glacier, e.g. with query_glaciers. Defaults to None (query with query_products)
+
+    returns: OrderedDict of product id: product properties for the downloaded products
+
+    Created by oew@geus.dk
+    27 Jan 2021
+
+    """
+
+    if api is None:
+        api = connect_api()
+    print('Downloading images for {}'.format(glacier))
+
+    if products is None:
+        products = query_products(glacier, from_date, to_date, max_cloud_percentage, api)
+
+    # Skip products that have already been downloaded and extracted
+    num_queried = len(products)
+    if unprocessed_image_directory is not None:
+        products = new_products(products, unprocessed_image_directory)
+        print('{} of {} products already downloaded for {}'.format(num_queried - len(products), num_queried, glacier))
+    num_products = len(products)
+
     if num_products == 0:
         print("No products matches for {}".format(glacier))
     else:
         print("Number of products: {}" .format(num_products))
         # Download collected products
-        # api.download_all(products, download_directory, nodefilter=path_filter)
-        api.download_all(products, download_directory)
+        with stage('download', glacier=glacier, products=num_products):
+            if image_type is None:
+                api.download_all(products, download_directory)
+            else:
+                api.download_all(products, download_directory, nodefilter=band_node_filter(image_type))
         print("Finished downloading {} products for {}".format(num_products, glacier))
+    return products
@@ -0,0 +1,198 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Timing and memory instrumentation of the processing stages (download, unzip, decode, reproject, render, savefig, ftp,
+...). Each stage is timed with
+
+    with stage('decode', glacier=glacier, date=date):
+        ...
+
+which records a dict with the stage name, the given fields, the wall and CPU time in seconds, and the peak resident
+memory (RSS) of the process in MB. Stages inside another stage in the same thread also get the fields of the enclosing
+stage, so e.g. the decode of a scene is labelled with its glacier and date. The peak RSS is the largest so far in the
+process, and peak_rss_growth_mb is how much the stage raised it. This only costs a few system calls per stage, so it
+can be left on in production.
+
+Records are kept in the process, and also written as json lines to METRICS_PATH when enabled with open_metrics_log.
+Worker processes (see render_scenes) return their records to the main process with drain_records, which adds them
+with add_records. summarize_records rolls the records up per stage and per glacier at the end of a run.
+"""
+
+METRICS_PATH = './processing_metrics.jsonl'
+
+# ru_maxrss is in bytes on macOS and in kilobytes on Linux
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+_records = []
+_lock = threading.Lock()
+_log = {'file': None, 'pid': None}
+_context = threading.local() # Fields of the enclosing stages of each thread
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory of this process in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT / 1e6
+
+
+def open_metrics_log(path=METRICS_PATH):
+    """
+    Writes the records of this run as json lines appended to path. Only records of this process are written; records of
+    worker processes are written when added with add_records.
+    """
+    close_metrics_log()
+    _log['file'] = open(path, 'a', buffering=1)
+    _log['pid'] = os.getpid()
+
+
+def close_metrics_log():
+    """
+    Stops writing records to the json lines file
+    """
+    if _log['file'] is not None and _log['pid'] == os.getpid():
+        _log['file'].close()
+    _log['file'] = _log['pid'] = None
+
+
+def _emit(record):
+    with _lock:
+        _records.append(record)
+        if _log['file'] is not None and _log['pid'] == os.getpid():
+            _log['file'].write(json.dumps(record) + '\n')
+
+
+@contextmanager
+def stage(name, **fields):
+    """
+    Context manager timing the stage name. fields (e.g. glacier, date) are added to the record. If the stage raises an
+    exception, the record gets an 'error' field and the exception is raised again.
+
+    yields: the fields dict, so values only known inside the stage can be added (e.g. fields['products'] = 3)
+    """
+    outer = getattr(_context, 'fields', {})
+    _context.fields = dict(outer, **fields)
+    start_rss = peak_rss_mb()
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield fields
+    except BaseException as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+        raise
+    finally:
+        end_rss = peak_rss_mb()
+        record = {
+                  'stage': name,
+                  'seconds': round(time.perf_counter() - start, 4),
+                  'cpu_seconds': round(time.process_time() - start_cpu, 4),
+                  'peak_rss_mb': round(end_rss, 1),
+                  'peak_rss_growth_mb': round(end_rss - start_rss, 1),
+                  'pid': os.getpid(),
+                  'time': time.time(),
+        }
+        record.update(outer)
+        record.update(fields)
+        _context.fields = outer
+        if error is not None:
+            record['error'] = error
+        _emit(record)
+
+
+def records():
+    """
+    Returns a copy of the records of this process
+    """
+    with _lock:
+        return list(_records)
+
+
+def drain_records():
+    """
+    Returns the records of this process and clears them. Used by worker processes to return their records
+    """
+    with _lock:
+        drained = list(_records)
+        del _records[:]
+    return drained
+
+
+def add_records(new_records):
+    """
+    Adds records from a worker process to the records of this process, and writes them to the json lines file
+    """
+    for record in new_records:
+        _emit(record)
+
+
+def reset_records():
+    """
+    Clears the records, and stops writing a json lines file opened by a parent process. Called when a worker process
+    starts
+    """
+    with _lock:
+        del _records[:]
+    _context.fields = {}
+    if _log['pid'] != os.getpid():
+        _log['file'] = _log['pid'] = None
+
+
+def summarize_records(stage_records=None):
+    """
+    Rolls up the records per stage and per glacier
+
+    stage_records: list of records. Defaults to None (the records of this process)
+
+    returns: dict with keys
+    'stages': dict of stage name: dict with count, errors, total, mean and max seconds, CPU seconds, max peak RSS in MB
+    and the total of the 'skipped' field of the records (e.g. duplicate products left out)
+    'glaciers': dict of glacier: dict of stage name: total seconds
+    """
+    if stage_records is None:
+        stage_records = records()
+    stages = {}
+    glaciers = {}
+    for record in stage_records:
+        summary = stages.setdefault(record['stage'], {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_mb': 0.0, 'skipped': 0})
+        summary['count'] += 1
+        summary['errors'] += 'error' in record
+        summary['seconds'] += record['seconds']
+        summary['max_seconds'] = max(summary['max_seconds'], record['seconds'])
+        summary['cpu_seconds'] += record['cpu_seconds']
+        summary['peak_rss_mb'] = max(summary['peak_rss_mb'], record['peak_rss_mb'])
+        summary['skipped'] += record.get('skipped', 0)
+        if record.get('glacier') is not None:
+            glacier = glaciers.setdefault(record['glacier'], {})
+            glacier[record['stage']] = glacier.get(record['stage'], 0.0) + record['seconds']
+    for summary in stages.values():
+        summary['mean_seconds'] = summary['seconds'] / summary['count']
+    return {'stages': stages, 'glaciers': glaciers}
+
+
+def report_summary(stage_records=None):
+    """
+    Prints the summary of summarize_records as a table, and writes it as a json line with stage 'summary' if the json
+    lines file is open
+
+    returns: the summary dict
+    """
+    summary = summarize_records(stage_records)
+    print('{:<12} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10}'.format('Stage', 'Count', 'Errors', 'Total [s]', 'Mean [s]', 'Max [s]', 'RSS [MB]'))
+    for name, s in sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']):
+        print('{:<12} {:>6} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.0f}'.format(name, s['count'], s['errors'], s['seconds'], s['mean_seconds'], s['max_seconds'], s['peak_rss_mb']))
+    for name, s in sorted(summary['stages'].items()):
+        if s['skipped']:
+            print('{}: skipped {}'.format(name, s['skipped']))
+    for glacier, glacier_stages in sorted(summary['glaciers'].items()):
+        print('{}: {}'.format(glacier, ', '.join('{} {:.1f} s'.format(name, seconds) for name, seconds in sorted(glacier_stages.items()))))
+    with _lock:
+        if _log['file'] is not None and _log['pid'] == os.getpid():
+            _log['file'].write(json.dumps(dict(summary, stage='summary', time=time.time())) + '\n')
+    return summary
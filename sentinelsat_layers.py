@@ -0,0 +1,68 @@
+import os
+from functools import lru_cache
+
+import geopandas
+from shapely.geometry import box
+
+"""
+Functions to load the ice extent outline drawn on top of the images in make_image.
+
+The shapefile is read once per process, and the boundary lines are reprojected once per projection. The reprojected
+boundaries are also stored as GeoPackage files in LAYER_CACHE_DIRECTORY, so later runs skip the reprojection. A cached
+file is rebuilt when the shapefile is newer than it.
+"""
+
+OUTLINE_PATH = './prom_total_man_corr_v2b.shp'
+LAYER_CACHE_DIRECTORY = './layer_cache.nosync'
+
+
+@lru_cache(maxsize=None)
+def read_outline(path=OUTLINE_PATH):
+    """
+    Returns the outline shapefile in path as a GeoDataFrame. Read only once per process.
+    """
+    return geopandas.read_file(path)
+
+
+@lru_cache(maxsize=None)
+def outline_boundary(to_crs, path=OUTLINE_PATH, cache_directory=LAYER_CACHE_DIRECTORY):
+    """
+    Returns the boundary lines of the outline in path, reprojected to to_crs, as a GeoSeries with a spatial index
+
+    to_crs: string with the projection, e.g. 'epsg:32622'
+    path: string with the path to the outline shapefile
+    cache_directory: string with the directory of the reprojected boundaries. None to only cache in memory
+    """
+    cache_path = None
+    if cache_directory is not None:
+        layer_name = os.path.splitext(os.path.basename(path))[0]
+        cache_path = os.path.join(cache_directory, '{}_{}.gpkg'.format(layer_name, to_crs.replace(':', '').lower()))
+
+    if cache_path is not None and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        boundary = geopandas.read_file(cache_path).geometry
+    else:
+        boundary = read_outline(path).to_crs(to_crs).boundary
+        if cache_path is not None:
+            os.makedirs(cache_directory, exist_ok=True)
+            # Written under a temporary name, as several worker processes may build the same file
+            temporary_path = '{}.{}.tmp.gpkg'.format(cache_path[:-5], os.getpid())
+            geopandas.GeoDataFrame(geometry=boundary).to_file(temporary_path, driver='GPKG')
+            os.replace(temporary_path, cache_path)
+
+    boundary.sindex # Build the spatial index once, before the boundary is shared between glaciers
+    return boundary
+
+
+@lru_cache(maxsize=None)
+def clipped_outline(to_crs, bounds, path=OUTLINE_PATH, cache_directory=LAYER_CACHE_DIRECTORY):
+    """
+    Returns the boundary lines of the outline in path within bounds, so only the few features inside the image are
+    plotted. Features are selected with the spatial index before being clipped.
+
+    to_crs: string with the projection, e.g. 'epsg:32622'
+    bounds: (minx, miny, maxx, maxy) in to_crs
+    """
+    boundary = outline_boundary(to_crs, path, cache_directory)
+    frame = box(*bounds)
+    features = boundary.iloc[boundary.sindex.query(frame)]
+    return geopandas.clip(features, frame)
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+
+from sentinelsat_glacier_definitions import glacier_definitions
+from sentinelsat_layers import OUTLINE_PATH
+
+"""
+Functions to keep a ledger of the scenes that have been processed, so a run only makes images for new or changed
+scenes.
+
+The ledger is a json file keyed by '<glacier>|<date>', with a fingerprint of everything the image depends on: the
+name, size and modification time of each input band, the root n, the rendering engine, the bounding box of the
+glacier, the overlay shapefile, and RENDER_VERSION. A scene is processed again if any of these change.
+"""
+
+LEDGER_PATH = './processing_ledger.json'
+RENDER_VERSION = 3 # Increase when make_image changes, to process all scenes again
+
+
+def scene_fingerprint(glacier, image_list, n, engine='matplotlib'):
+    """
+    Returns a fingerprint (hex string) of the inputs and parameters of the image of glacier made from image_list
+    """
+    inputs = []
+    for image in sorted(image_list):
+        stat = os.stat(image)
+        inputs.append([os.path.basename(image), stat.st_size, int(stat.st_mtime)])
+    overlay = None
+    if os.path.exists(OUTLINE_PATH):
+        stat = os.stat(OUTLINE_PATH)
+        overlay = [stat.st_size, int(stat.st_mtime)]
+    parameters = {
+                  'n': n,
+                  'engine': engine,
+                  'bounding_box': glacier_definitions(glacier, 'bounding_box'),
+                  'overlay': overlay,
+                  'render_version': RENDER_VERSION,
+    }
+    return hashlib.sha1(json.dumps([inputs, parameters], sort_keys=True).encode()).hexdigest()
+
+
+def load_ledger(ledger_path=LEDGER_PATH):
+    """
+    Returns the ledger in ledger_path as a dict of '<glacier>|<date>': fingerprint. Empty if there is no ledger.
+    """
+    if not os.path.exists(ledger_path):
+        return {}
+    with open(ledger_path, 'r') as file:
+        return json.load(file)
+
+
+def save_ledger(ledger, ledger_path=LEDGER_PATH):
+    """
+    Writes ledger to ledger_path, replacing the file in one step
+    """
+    with open(ledger_path + '.tmp', 'w') as file:
+        json.dump(ledger, file, indent=1, sort_keys=True)
+    os.replace(ledger_path + '.tmp', ledger_path)
+
+
+def pending_scenes(scenes, n, ledger_path=LEDGER_PATH, force=False, verbose=True, engine='matplotlib'):
+    """
+    Returns the scenes that are new or changed since they were last processed
+
+    scenes: list of (glacier, date, image_list) tuples, as returned by glacier_scenes
+    force: bool to return all scenes, regardless of the ledger
+    verbose: bool to print the number of scenes already processed
+    engine: rendering engine the images are made with. Scenes made with another engine are processed again
+    """
+    if force:
+        return list(scenes)
+    ledger = load_ledger(ledger_path)
+    pending = [scene for scene in scenes if ledger.get('{}|{}'.format(scene[0], scene[1])) != scene_fingerprint(scene[0], scene[2], n, engine)]
+    if verbose:
+        print('{} of {} scenes already processed'.format(len(scenes) - len(pending), len(scenes)))
+    return pending
+
+
+def record_scenes(scenes, results, n, ledger_path=LEDGER_PATH, engine='matplotlib'):
+    """
+    Adds the successfully processed scenes to the ledger. Scenes skipped for their quality are left out, so they are
+    checked again if the quality threshold is changed.
+
+    scenes: list of (glacier, date, image_list) tuples that were processed
+    results: list of dicts as returned by render_scenes, in the order of scenes
+    engine: rendering engine the images were made with
+    """
+    ledger = load_ledger(ledger_path)
+    for scene, result in zip(scenes, results):
+        if result['success'] and not result.get('skipped'):
+            ledger['{}|{}'.format(scene[0], scene[1])] = scene_fingerprint(scene[0], scene[2], n, engine)
+    save_ledger(ledger, ledger_path)
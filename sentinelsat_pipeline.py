@@ -0,0 +1,333 @@
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from sentinelsat_catalog import record_quality
+from sentinelsat_functions import band_node_filter, extract_product, glacier_scenes, scenes_in_range, select_scenes, scene_groups, init_render_worker, render_group_worker
+from sentinelsat_ftp import FTP_HOST, ftp_credentials, connect_ftp, upload_worker
+from sentinelsat_instrumentation import stage, add_records
+from sentinelsat_ledger import LEDGER_PATH, pending_scenes, record_scenes
+from sentinelsat_product_store import new_products, register_products, touch_files
+
+"""
+Streaming version of the processing, where download, extraction, rendering and upload run at the same time:
+
+download threads -> extract queue -> extract thread -> scene queue -> render processes -> upload queue -> ftp threads
+
+The scene queue holds groups of scenes, which are made together by one render process. With shared_reads the scenes
+of the same date that share a tile are grouped, so each tile is read once for all glaciers using it (see
+SharedTileReader in sentinelsat_functions.py). Otherwise each group is a single scene.
+
+Each product is extracted as soon as it is downloaded, each scene is rendered as soon as all products of its date
+(one for each tile of the glacier) are in the image store, and each image is uploaded as soon as it is written.
+
+The queues are bounded, so a slow stage holds back the stages before it. At most max_pending_products downloaded
+products wait to be extracted, which limits the disk space used in download_directory, and at most
+max_pending_scenes scenes wait for a render process.
+"""
+
+STOP = None # Put in a queue when no more items follow
+
+
+def _scene_key(glacier, title):
+    """
+    Returns the (glacier, date) of the scene the product title belongs to. The sensing time in the title is the date in
+    the band filenames, e.g. 'S2A_MSIL1C_20200701T151641_N0209_R068_T22WEB_20200701T170000' -> '20200701T151641'
+    """
+    return glacier, title.split('_')[2]
+
+
+def _download_worker(product_queue, extract_queue, api, download_directory, nodefilter):
+    """
+    Downloads the products in product_queue until it returns STOP, and puts (title, success) in extract_queue for each.
+    Blocks when extract_queue is full.
+    """
+    while True:
+        item = product_queue.get()
+        if item is STOP:
+            break
+        uuid, title = item
+        try:
+            with stage('download', product=title):
+                api.download(uuid, download_directory, nodefilter=nodefilter)
+        except Exception as e: # E.g. a product that is offline in the long term archive
+            print('Failed to download {}. Reason: {}'.format(title, e))
+            extract_queue.put((title, False))
+        else:
+            extract_queue.put((title, True))
+
+
+class _SceneTracker:
+    """
+    Keeps track of the products each scene is still waiting for, and finds the scenes of a glacier that are complete
+    """
+
+    def __init__(self, glacier_list, products, image_directory, n, ledger_path, force, engine='matplotlib'):
+        self.image_directory = image_directory
+        self.n = n
+        self.engine = engine
+        self.ledger_path = ledger_path
+        self.force = force
+        self.waiting = {} # (glacier, date): set of titles
+        self.scenes_of = {} # title: list of (glacier, date)
+        for glacier in glacier_list:
+            for properties in products.get(glacier, {}).values():
+                key = _scene_key(glacier, properties['title'])
+                self.waiting.setdefault(key, set()).add(properties['title'])
+                self.scenes_of.setdefault(properties['title'], []).append(key)
+
+    def initial_scenes(self, glacier_list, from_date=None, to_date=None):
+        """
+        Returns the pending scenes already in the image store, which are not waiting for any product
+        from_date, to_date: only return the scenes sensed in this date range (see scenes_in_range). Defaults to None
+        (all scenes)
+        """
+        scenes = [scene for glacier in glacier_list for scene in glacier_scenes(glacier, self.image_directory) if (scene[0], scene[1]) not in self.waiting]
+        if from_date is not None and to_date is not None:
+            scenes = scenes_in_range(scenes, from_date, to_date)
+        return pending_scenes(scenes, self.n, self.ledger_path, self.force, engine=self.engine)
+
+    def product_done(self, title):
+        """
+        Marks the product title as extracted (or failed), and returns the pending scenes it completed
+        """
+        complete = []
+        for key in self.scenes_of.get(title, []):
+            self.waiting[key].discard(title)
+            if not self.waiting[key]:
+                del self.waiting[key]
+                complete.append(key)
+        scenes = []
+        for glacier in sorted(set(glacier for glacier, date in complete)):
+            scenes += [scene for scene in glacier_scenes(glacier, self.image_directory) if (scene[0], scene[1]) in complete]
+        return pending_scenes(scenes, self.n, self.ledger_path, self.force, verbose=False, engine=self.engine)
+
+
+def _group_scenes(scenes, shared_reads):
+    """
+    Returns the groups of scenes put in the scene queue
+    """
+    return scene_groups(scenes) if shared_reads else [[scene] for scene in scenes]
+
+
+def _extract_worker(extract_queue, scene_queue, tracker, products, download_directory, image_directory, image_type, shared_reads=False):
+    """
+    Extracts the products in extract_queue until it returns STOP, adds them to the image store, and puts the groups of
+    scenes they complete in scene_queue. Runs in a single thread, so the manifest is only written by one thread. A
+    product that fails is reported and left out, and the thread goes on with the next one, so the download threads are
+    never left waiting on a full extract_queue.
+    """
+    while True:
+        item = extract_queue.get()
+        if item is STOP:
+            break
+        title, downloaded = item
+        try:
+            if downloaded:
+                try:
+                    files = extract_product(download_directory, title, image_directory, image_type)
+                except Exception as e:
+                    print('Failed to extract {}. Reason: {}'.format(title, e))
+                else:
+                    register_products(image_directory, {title: files}, products)
+            scenes = tracker.product_done(title)
+            touch_files(image_directory, [f for scene in scenes for f in scene[2]])
+            groups = _group_scenes(scenes, shared_reads)
+        except Exception as e: # E.g. a manifest or catalog that cannot be written. The thread keeps draining extract_queue
+            print('Failed to add {} to the image store. Reason: {}'.format(title, e))
+            continue
+        for group in groups:
+            scene_queue.put(group)
+
+
+def _render_dispatcher(scene_queue, finished_queue, producers, n, processed_image_directory, workers, engine, min_quality=None, cutout_directory=None):
+    """
+    Submits the groups of scenes in scene_queue to a pool of workers processes until each of producers has put STOP,
+    with at most workers groups rendering at a time. Puts (scene, result) in finished_queue for each scene. A group that
+    cannot be submitted because a worker process died and broke the pool is submitted again to a new pool, and only
+    reported as failed if that also fails, so the scene queue is drained until all producers are done.
+
+    The worker processes are started with spawn instead of fork, as a process forked while the other threads of the
+    pipeline hold locks could wait for them forever.
+    """
+    slots = threading.Semaphore(max(1, workers))
+
+    def failed(group, e):
+        return [{'glacier': scene[0], 'date': scene[1], 'success': False, 'error': '{}: {}'.format(type(e).__name__, e), 'files': [], 'skipped': False, 'quality': None} for scene in group]
+
+    def finished(group, future):
+        try:
+            results, stages = future.result()
+            add_records(stages)
+        except Exception as e: # E.g. a worker process killed by running out of memory
+            results = failed(group, e)
+        for scene, result in zip(group, results):
+            finished_queue.put((scene, result))
+        slots.release()
+
+    def start_pool():
+        return ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context('spawn'), initializer=init_render_worker)
+
+    executor = start_pool()
+    try:
+        while producers:
+            group = scene_queue.get()
+            if group is STOP:
+                producers -= 1
+                continue
+            slots.acquire() # Leaves the scene queue to fill up while all workers are busy
+            future = None
+            for attempt in range(2):
+                try:
+                    future = executor.submit(render_group_worker, group, n, processed_image_directory, engine, min_quality, cutout_directory)
+                    break
+                except BrokenProcessPool as e: # A worker process died. The group did not run, so it is submitted again
+                    print('Restarting the render processes. Reason: {}'.format(e))
+                    executor.shutdown(wait=False)
+                    executor = start_pool()
+                    error = e
+                except Exception as e:
+                    error = e
+                    break
+            if future is None: # The scene queue is still drained
+                for scene, result in zip(group, failed(group, error)):
+                    finished_queue.put((scene, result))
+                slots.release()
+                continue
+            future.add_done_callback(lambda future, group=group: finished(group, future))
+    finally:
+        executor.shutdown(wait=True)
+
+
+def _collect_results(finished_queue, upload_queue, scenes, results, n, ledger_path, upload_workers, engine='matplotlib'):
+    """
+    Records the rendered scenes in the ledger and queues their images for upload, until finished_queue returns STOP.
+    Then puts STOP in upload_queue for each of upload_workers. The scenes and their results are appended to scenes and
+    results.
+    """
+    try:
+        while True:
+            item = finished_queue.get()
+            if item is STOP:
+                break
+            scene, result = item
+            record_scenes([scene], [result], n, ledger_path, engine)
+            scenes.append(scene)
+            results.append(result)
+            if result['skipped']:
+                print('Skipped {} {} with quality {:.2f}'.format(scene[0], scene[1], result['quality']['score']))
+            elif result['success']:
+                print('Processed {} {}'.format(scene[0], scene[1]))
+                if upload_queue is not None:
+                    for path in result['files']:
+                        upload_queue.put(path)
+            else:
+                print('Failed to process {} {}. Reason: {}'.format(scene[0], scene[1], result['error']))
+    finally: # Also on an error, e.g. writing the ledger, so the upload threads finish and the pipeline is not left waiting
+        for i in range(upload_workers):
+            upload_queue.put(STOP)
+
+
+def stream_process(glacier_list, products, download_directory, unprocessed_image_directory, processed_image_directory, image_type, n, api=None, band_fetch=False, download_workers=2, workers=1, engine='matplotlib', ledger_path=LEDGER_PATH, force=False, min_quality=None, cutout_directory=None, shared_reads=False, upload=True, processed_image_uploaded_directory=None, ftp_workers=4, max_pending_products=2, max_pending_scenes=None, max_pending_uploads=100, host=FTP_HOST, port=21, username=None, password=None, directory='upload', from_date=None, to_date=None):
+    """
+    Downloads, extracts, renders and uploads the images of glacier_list as a streaming pipeline
+
+    glacier_list: list of glaciers
+    products: dict of glacier: OrderedDict of product id: product properties, as returned by query_glaciers. Products
+    already in the image store are not downloaded again.
+    api: SentinelAPI (or a stand-in with the same download method) to use. Only used if there are products to download
+    band_fetch: bool to download only the image_type band files of each product instead of the full zip-files
+    download_workers: integer number of products downloaded at the same time
+    workers: integer number of processes used to make the images
+    upload: bool to upload the images. Uploaded images are moved to processed_image_uploaded_directory
+    ftp_workers: integer number of concurrent ftp sessions
+    max_pending_products: integer number of downloaded products that may wait to be extracted
+    shared_reads: bool to make the scenes of the same date sharing a tile together, reading the tile once (see render_scenes)
+    max_pending_scenes: integer number of groups of complete scenes that may wait for a render process. Defaults to None (2 * workers)
+    max_pending_uploads: integer number of images that may wait to be uploaded
+    host, port, directory, username, password: ftp server and credentials, see sentinelsat_ftp_upload
+    from_date, to_date: date range of the scenes already in the image store that are made (see scenes_in_range).
+    Defaults to None (all pending scenes in the image store)
+
+    See sentinel_process for the other arguments.
+
+    returns: list of dicts with keys 'glacier', 'date', 'success', 'error', 'files', 'skipped' and 'quality', one for
+    each processed scene, in the order they were finished
+    """
+    # Products to download, once even if they cover more than one glacier
+    wanted = {glacier: new_products(products.get(glacier, {}), unprocessed_image_directory) for glacier in glacier_list}
+    to_download = {}
+    for glacier_products in wanted.values():
+        to_download.update(glacier_products)
+    print('Streaming {} products to download for {} glaciers'.format(len(to_download), len(glacier_list)))
+
+    # Scenes already in the image store are found before the threads start, as only the extract thread may write the
+    # catalog and manifest of the image store while they run
+    tracker = _SceneTracker(glacier_list, wanted, unprocessed_image_directory, n, ledger_path, force, engine)
+    initial_scenes = select_scenes(tracker.initial_scenes(glacier_list, from_date, to_date), unprocessed_image_directory, min_quality, force)
+    touch_files(unprocessed_image_directory, [f for scene in initial_scenes for f in scene[2]])
+    product_queue = queue.Queue()
+    extract_queue = queue.Queue(maxsize=max(1, max_pending_products))
+    scene_queue = queue.Queue(maxsize=max_pending_scenes or 2 * max(1, workers))
+    finished_queue = queue.Queue()
+    upload_queue = queue.Queue(maxsize=max(1, max_pending_uploads)) if upload else None
+    scenes = []
+    results = []
+    upload_results = []
+
+    nodefilter = band_node_filter(image_type) if band_fetch else None
+    for uuid, properties in to_download.items():
+        product_queue.put((uuid, properties['title']))
+    downloaders = [threading.Thread(target=_download_worker, args=(product_queue, extract_queue, api, download_directory, nodefilter)) for i in range(min(max(1, download_workers), len(to_download)))]
+    for thread in downloaders:
+        product_queue.put(STOP)
+
+    def extract():
+        try:
+            _extract_worker(extract_queue, scene_queue, tracker, to_download, download_directory, unprocessed_image_directory, image_type, shared_reads)
+        finally:
+            scene_queue.put(STOP)
+
+    def initial():
+        try:
+            for group in _group_scenes(initial_scenes, shared_reads):
+                scene_queue.put(group)
+        finally:
+            scene_queue.put(STOP)
+
+    def render():
+        try:
+            _render_dispatcher(scene_queue, finished_queue, 2, n, processed_image_directory, workers, engine, min_quality, cutout_directory)
+        finally:
+            finished_queue.put(STOP)
+
+    threads = [
+               threading.Thread(target=initial),
+               threading.Thread(target=extract),
+               threading.Thread(target=render),
+               threading.Thread(target=_collect_results, args=(finished_queue, upload_queue, scenes, results, n, ledger_path, ftp_workers if upload else 0, engine)),
+    ]
+    if upload:
+        if username is None:
+            username, password = ftp_credentials()
+
+        def connect():
+            return connect_ftp(host, port, username, password, directory)
+        threads += [threading.Thread(target=upload_worker, args=(upload_queue, upload_results, connect, processed_image_uploaded_directory, 3, 2)) for i in range(ftp_workers)]
+
+    with stage('stream', products=len(to_download), workers=workers):
+        for thread in downloaders + threads:
+            thread.start()
+        for thread in downloaders:
+            thread.join()
+        extract_queue.put(STOP) # All downloads are queued for extraction
+        for thread in threads:
+            thread.join()
+    record_quality(unprocessed_image_directory, scenes, results)
+
+    if upload:
+        failed = [r for r in upload_results if not r['success']]
+        print('Uploaded {} of {} files'.format(len(upload_results) - len(failed), len(upload_results)))
+    return results
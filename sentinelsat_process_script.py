@@ -1,47 +1,100 @@
-from sentinelsat_functions import sentinel_process
-from sentinelsat_ftp import sentinelsat_ftp_upload
+import argparse
+import os
+import sys
 """
-Script to call the download and processing of images to make calving front images for Polarportal.
+Command line script to download and process images to make calving front images for Polarportal.
 
-Calls function sentinel_process in sentinelsat_functions.py. This file also contains all other functions required for processing EXCEPT for the function glacier_definitions in sentinalsat_glacier_definitions.py.
+Usage: python sentinelsat_process_script.py <command> [options]
 
-Variables to specify:
-from_date: string formatted 'YYYYMMDD' or 'NOW' or 'NOW-kDAYS' where k is integer
+Commands:
+download: query the Copernicus SciHub and download the products of the glaciers not already in the image store
+extract: extract the band images of the downloaded products to the unprocessed image directory
+render: make the images of the scenes that are new or changed since they were last processed (see sentinelsat_ledger.py)
+upload: upload the processed images to the DMI ftp server
+timelapse: add the scenes not yet in the time series cube of each glacier (see sentinelsat_timeseries.py), and make a time lapse GIF and a change image of the last two dates from the cube
+run: all of the above, in order. With --stream, the products are downloaded, extracted, rendered and uploaded as a
+streaming pipeline, so the network and CPU are busy at the same time (see sentinelsat_pipeline.py)
+
+Run python sentinelsat_process_script.py <command> --help for the options of each command. The defaults are set below.
+With --dry-run, each command only prints what it would do. Modules are imported by the commands that need them, so
+e.g. upload does not import rasterio, geopandas and matplotlib.
+
+Default values of the options:
+from_date: string formatted 'YYYYMMDD' or 'NOW' or 'NOW-kDAYS' (or MONTHS or YEARS) where k is integer. Products are
+downloaded, and scenes are rendered, from from_date to to_date
 to_date: same as above
+download_products: bool to download new products in run. False processes the images already in the image store
 download_directory: string containing the target directory to place downloads.
-unprocessed_image_directory: string containing the directory of unprocessed images (for clearing it)
+unprocessed_image_directory: string containing the directory of the extracted images, kept between runs (see sentinelsat_product_store.py)
 processed_image_directory: string containing the directory where the processed calving front region images will be placed
-image_type: string containing the used band in the Sentinel download. Can be bands 'B01' through 'B12' or 'TCI' (true-color image)
+processed_image_uploaded_directory: string containing the directory the images are moved to when uploaded
+image_type: tuple of strings containing the used bands in the Sentinel download. Can be bands 'B01' through 'B12' or 'TCI' (true-color image)
+n: root of each band in RGB-composite
 max_cloud_percentage: integer. Only downloads images with set percentage of cloud cover as classified by ESA algorithm
-download: bool to control whether or not the images should be downloaded. If downloaded, all images in the directory unprocessed_image_directory will be deleted. Allows for code development of image processing with already downloaded images, without having to download again. Defaults to True.
-glacier_list: list of glaciers to download and process images for
+workers: integer number of processes used to make the images. The (glacier, date) scenes of all glaciers are spread across the processes
+unzip_workers: integer number of zip-files extracted at the same time
+download_workers: integer number of products downloaded at the same time by the streaming pipeline
+max_pending_products: integer number of downloaded products that may wait to be extracted in the streaming pipeline. Limits the disk space used in download_directory
+band_fetch: bool to download only the image_type band files of each product instead of the full zip-files
+query_workers: integer number of concurrent queries to the Copernicus SciHub (one query per glacier)
+ftp_workers: integer number of concurrent ftp sessions used to upload the images
+engine: rendering engine for the images. 'matplotlib' or 'pil' (faster, draws directly into pixel buffers)
+min_quality: minimum fraction (0-1) of the glacier window with data and without bright (cloud) pixels for a scene to be rendered. Checked on a low resolution read before rendering, and stored in the scene catalog. None to render all scenes
+cutout_directory: directory where the merged window of each scene is kept as a compressed GeoTIFF, so images can be made again (e.g. with another n) without decoding the tiles (see sentinelsat_cutouts.py). None to not keep cutouts
+shared_reads: bool to make the scenes of glaciers sharing a tile on the same date together in one process, decoding the tile once over the union of the glacier windows instead of once per glacier
+gdal_cache_mb: size in MB of the GDAL block cache of each process that reads the images (see sentinelsat_datasets.py)
+cube_directory: directory of the time series cube of each glacier. render adds the new scenes to it. None to not keep cubes
+timelapse_directory: directory of the time lapses and change images made by timelapse
+frame_duration: time in ms each date is shown in the time lapses
+max_store_gb: maximum size in GB of the extracted images kept in unprocessed_image_directory. The images of the least recently used products are deleted when exceeded
+max_cutout_gb: maximum size in GB of the cutouts kept in cutout_directory. The least recently used cutouts are deleted when exceeded
+ledger_path: json file with the scenes already processed (see sentinelsat_ledger.py)
+metrics_path: json lines file the time and peak memory of each processing stage are appended to (see sentinelsat_instrumentation.py). A summary is printed at the end of the run
 
 Created by oew@geus.dk
 3 Feb 2021
 
 """
 
-# Variables passed to function
+# Default values of the options
 from_date = 'NOW-2YEAR'
 to_date = 	'NOW'
 download_directory = './downloaded_files.nosync'
 unprocessed_image_directory = './unprocessed_images.nosync'
 processed_image_directory = './output_images_to_upload.nosync'
 processed_image_uploaded_directory = './output_images_uploaded.nosync'
+cutout_directory = './cutouts.nosync'
+cube_directory = './timeseries.nosync'
+timelapse_directory = './timelapse.nosync'
 #image_type = 'TCI.jp2' # Truecolor images. Can also be any other band in the zip-file
 image_type = ('B02.jp2', 'B03.jp2', 'B04.jp2') # New function makes RGB composites
 n = 2 # root of each band in RGB-composite
 max_cloud_percentage = 20
-download = False;
-upload = True;
+download_products = False
+workers = 4
+unzip_workers = 4
+download_workers = 2
+max_pending_products = 2
+band_fetch = True
+query_workers = 4
+ftp_workers = 4
+engine = 'matplotlib'
+shared_reads = True
+gdal_cache_mb = 512
+frame_duration = 500
+min_quality = 0.05
+max_store_gb = 200
+max_cutout_gb = 50
+ledger_path = './processing_ledger.json'
+metrics_path = './processing_metrics.jsonl'
 
 glacier_list = [
-'Ryder', 
-'Petermann', 
-'Humboldt', 
-'Steenstrup', 
-'Hayes', 
-'Nunatakassaap Sermia', 
+'Ryder',
+'Petermann',
+'Humboldt',
+'Steenstrup',
+'Hayes',
+'Nunatakassaap Sermia',
 'Upernavik',
 'Kangilleq',
 'Store',
@@ -59,13 +112,300 @@ glacier_list = [
 ]
 
 
-glacier_list = ['Jakobshavn']
-for glacier in glacier_list:
-	sentinel_process(glacier, from_date, to_date, download_directory, unprocessed_image_directory, processed_image_directory, image_type, n, max_cloud_percentage, download)
-print('Finished processing all glaciers from {} to {}'.format(from_date, to_date))
+def check_glaciers(glaciers):
+	"""
+	Exits with an error message if any of glaciers is not in the glacier registry (sentinelsat_glacier_definitions.json)
+	"""
+	from sentinelsat_glacier_definitions import GLACIERS
+	unknown = [glacier for glacier in glaciers if glacier not in GLACIERS]
+	if unknown:
+		sys.exit('Unknown glaciers: {}. Defined glaciers: {}'.format(', '.join(unknown), ', '.join(sorted(GLACIERS))))
+
+
+def download(args):
+	"""
+	Queries and downloads the products of args.glaciers. Returns dict of glacier: OrderedDict of the downloaded products
+	"""
+	from sentinelsat_functions import connect_api, query_glaciers, download_sentinel
+	from sentinelsat_product_store import new_products
+
+	check_glaciers(args.glaciers)
+	api = connect_api()
+	queried = query_glaciers(args.glaciers, args.from_date, args.to_date, args.max_cloud_percentage, args.query_workers, api)
+	downloaded = {}
+	for glacier in args.glaciers:
+		if args.dry_run:
+			products = new_products(queried[glacier], args.image_directory)
+			print('Would download {} of {} products for {}'.format(len(products), len(queried[glacier]), glacier))
+			for properties in products.values():
+				print('  {}'.format(properties['title']))
+			continue
+		downloaded[glacier] = download_sentinel(glacier, args.from_date, args.to_date, args.download_directory, args.max_cloud_percentage, args.image_directory, image_type if args.band_fetch else None, api, queried[glacier])
+	return downloaded
+
+
+def extract(args, products=None):
+	"""
+	Extracts the downloaded products to the image store
+	products: dict of glacier: OrderedDict of product properties, as returned by download. Used to store the uuid of
+	each product. Optional
+	"""
+	from sentinelsat_functions import unzip_images
+	from sentinelsat_product_store import register_products
+
+	if args.dry_run:
+		pending = sorted(f for f in os.listdir(args.download_directory) if f.endswith('.zip') or f.endswith('.SAFE')) if os.path.isdir(args.download_directory) else []
+		print('Would extract {} products from {}'.format(len(pending), args.download_directory))
+		for f in pending:
+			print('  {}'.format(f))
+		return
+	merged = {}
+	for glacier_products in (products or {}).values():
+		merged.update(glacier_products)
+	extracted = unzip_images(args.download_directory, args.image_directory, image_type, args.unzip_workers)
+	register_products(args.image_directory, extracted, merged)
+
+
+def render(args):
+	"""
+	Makes the images of the new or changed scenes of args.glaciers sensed from args.from_date to args.to_date
+	"""
+	from sentinelsat_functions import glacier_scenes, scenes_in_range, select_scenes, render_scenes, report_render_results
+	from sentinelsat_catalog import load_catalog, index_scenes, record_quality
+	from sentinelsat_ledger import pending_scenes, record_scenes
+	from sentinelsat_product_store import touch_files, evict_products
+	from sentinelsat_cutouts import evict_cutouts
+	from sentinelsat_datasets import set_gdal_cache, gdal_cache_setting
+
+	check_glaciers(args.glaciers)
+	index = index_scenes(load_catalog(args.image_directory))
+	scenes = [scene for glacier in args.glaciers for scene in glacier_scenes(glacier, args.image_directory, index)]
+	scenes = scenes_in_range(scenes, args.from_date, args.to_date)
+	scenes = pending_scenes(scenes, args.n, args.ledger, args.force, engine=args.engine)
+	scenes = select_scenes(scenes, args.image_directory, args.min_quality, args.force)
+	if args.dry_run:
+		print('Would process {} scenes'.format(len(scenes)))
+		for glacier, date, image_list in scenes:
+			print('  {} {} ({} images)'.format(glacier, date, len(image_list)))
+		return
+	touch_files(args.image_directory, [f for scene in scenes for f in scene[2]])
+
+	set_gdal_cache(args.gdal_cache_mb)
+	print('Processing {} scenes for {} glaciers using {} workers, with a GDAL block cache of {} MB per process'.format(len(scenes), len(args.glaciers), args.workers, gdal_cache_setting()))
+	os.makedirs(args.output_directory, exist_ok=True)
+	results = render_scenes(scenes, args.n, args.output_directory, args.workers, args.engine, args.min_quality, args.cutout_directory, args.shared_reads)
+	record_quality(args.image_directory, scenes, results)
+	record_scenes(scenes, results, args.n, args.ledger, args.engine)
+	report_render_results(results)
+	if args.cube_directory:
+		append_to_cubes(args, scenes, results)
+	evict_products(args.image_directory, args.max_store_gb * 1e9)
+	if args.cutout_directory:
+		evict_cutouts(args.cutout_directory, args.max_cutout_gb * 1e9)
+	print('Finished processing all glaciers from {} to {}'.format(args.from_date, args.to_date))
+
+
+def append_to_cubes(args, scenes, results):
+	"""
+	Adds the successfully rendered scenes to the time series cubes of their glaciers
+	"""
+	from sentinelsat_timeseries import append_scenes
+
+	rendered = [scene for scene, result in zip(scenes, results) if result['success'] and not result.get('skipped')]
+	written = append_scenes(rendered, args.n, args.cube_directory, args.cutout_directory)
+	print('Added {} scenes to the time series cubes in {}'.format(written, args.cube_directory))
+
+
+def timelapse(args):
+	"""
+	Adds the scenes not yet in the time series cubes of args.glaciers, and makes a time lapse and a change image of each
+	"""
+	from sentinelsat_functions import glacier_scenes, select_scenes
+	from sentinelsat_catalog import load_catalog, index_scenes
+	from sentinelsat_glacier_definitions import glacier_definitions
+	from sentinelsat_timeseries import append_scenes, load_cube_index, timelapse_gif, difference_image
+
+	check_glaciers(args.glaciers)
+	index = index_scenes(load_catalog(args.image_directory))
+	scenes = [scene for glacier in args.glaciers for scene in glacier_scenes(glacier, args.image_directory, index)]
+	scenes = select_scenes(scenes, args.image_directory, args.min_quality)
+	if args.dry_run:
+		for glacier in args.glaciers:
+			dates = load_cube_index(args.cube_directory, glacier)['dates']
+			new = [scene for scene in scenes if scene[0] == glacier and scene[1] not in dates]
+			print('  {}: {} dates in the cube, {} new scenes'.format(glacier, len(dates), len(new)))
+		return
+
+	written = append_scenes(scenes, args.n, args.cube_directory, args.cutout_directory)
+	print('Added {} scenes to the time series cubes in {}'.format(written, args.cube_directory))
+	os.makedirs(args.timelapse_directory, exist_ok=True)
+	for glacier in args.glaciers:
+		outlet_number = glacier_definitions(glacier, 'outlet_number')
+		path = os.path.join(args.timelapse_directory, 'Outlet_{}_timelapse.gif'.format(outlet_number))
+		frames = timelapse_gif(glacier, path, args.cube_directory, args.since, args.frame_duration)
+		if frames == 0:
+			print('No dates in the time series of {}'.format(glacier))
+			continue
+		print('Made time lapse of {} with {} dates: {}'.format(glacier, frames, path))
+		dates = sorted(date for date in load_cube_index(args.cube_directory, glacier)['dates'] if args.since is None or date[:8] >= args.since)
+		if len(dates) > 1:
+			path = os.path.join(args.timelapse_directory, 'Outlet_{}_change_{}_{}.png'.format(outlet_number, dates[-2][:8], dates[-1][:8]))
+			difference_image(glacier, dates[-2], dates[-1], path, args.cube_directory)
+			print('Made change image of {}: {}'.format(glacier, path))
+
+
+def upload(args):
+	"""
+	Uploads the processed images, and moves them to the uploaded directory
+	"""
+	from sentinelsat_ftp import sentinelsat_ftp_upload
+
+	if args.dry_run:
+		pending = sorted(f for f in os.listdir(args.output_directory) if f.endswith('.png'))
+		print('Would upload {} images from {}'.format(len(pending), args.output_directory))
+		for f in pending:
+			print('  {}'.format(f))
+		return
+	sentinelsat_ftp_upload(args.output_directory, args.uploaded_directory, args.ftp_workers)
+
+
+def stream(args):
+	"""
+	Runs download (unless --no-download), extract, render and upload (unless --no-upload) as a streaming pipeline
+	"""
+	from sentinelsat_functions import connect_api, query_glaciers, glacier_scenes, report_render_results
+	from sentinelsat_pipeline import stream_process
+	from sentinelsat_product_store import evict_products
+	from sentinelsat_cutouts import evict_cutouts
+	from sentinelsat_datasets import set_gdal_cache, gdal_cache_setting
+
+	check_glaciers(args.glaciers)
+	api = None
+	products = {}
+	if args.download:
+		api = connect_api()
+		products = query_glaciers(args.glaciers, args.from_date, args.to_date, args.max_cloud_percentage, args.query_workers, api)
+	for directory in (args.download_directory, args.image_directory, args.output_directory, args.uploaded_directory):
+		os.makedirs(directory, exist_ok=True)
+	set_gdal_cache(args.gdal_cache_mb)
+	print('GDAL block cache of {} MB per process'.format(gdal_cache_setting()))
+	results = stream_process(args.glaciers, products, args.download_directory, args.image_directory, args.output_directory, image_type, args.n, api, args.band_fetch, args.download_workers, args.workers, args.engine, args.ledger, args.force, args.min_quality, args.cutout_directory, args.shared_reads, args.upload, args.uploaded_directory, args.ftp_workers, args.max_pending_products, from_date=args.from_date, to_date=args.to_date)
+	report_render_results(results)
+	if args.cube_directory:
+		rendered = {(r['glacier'], r['date']): r for r in results}
+		scenes = [scene for glacier in args.glaciers for scene in glacier_scenes(glacier, args.image_directory) if (scene[0], scene[1]) in rendered]
+		append_to_cubes(args, scenes, [rendered[(scene[0], scene[1])] for scene in scenes])
+	evict_products(args.image_directory, args.max_store_gb * 1e9)
+	if args.cutout_directory:
+		evict_cutouts(args.cutout_directory, args.max_cutout_gb * 1e9)
+
+
+def run(args):
+	"""
+	Runs download (unless --no-download), extract, render and upload (unless --no-upload)
+	"""
+	if args.stream and not args.dry_run:
+		return stream(args)
+	products = None
+	if args.download:
+		products = download(args)
+	extract(args, products)
+	render(args)
+	if args.upload:
+		upload(args)
+
+
+def parse_arguments(argv=None):
+	"""
+	Returns the parsed command line arguments
+	"""
+	parser = argparse.ArgumentParser(description='Download and process Sentinel-2 images to make calving front images for Polarportal.')
+	commands = parser.add_subparsers(dest='command', metavar='command', required=True)
+
+	common = argparse.ArgumentParser(add_help=False)
+	common.add_argument('--dry-run', action='store_true', help='only print what would be done')
+	common.add_argument('--metrics', default=metrics_path, help='json lines file for the stage timings (default: %(default)s). Empty to not write it')
+
+	glaciers = argparse.ArgumentParser(add_help=False)
+	glaciers.add_argument('-g', '--glaciers', nargs='+', default=glacier_list, metavar='GLACIER', help='glaciers to process (default: all)')
+
+	dates = argparse.ArgumentParser(add_help=False)
+	dates.add_argument('--from-date', default=from_date, help='start of the date range, YYYYMMDD or NOW-<k>DAYS (default: %(default)s)')
+	dates.add_argument('--to-date', default=to_date, help='end of the date range (default: %(default)s)')
+
+	store = argparse.ArgumentParser(add_help=False)
+	store.add_argument('--image-directory', default=unprocessed_image_directory, help='store of extracted images (default: %(default)s)')
+
+	downloads = argparse.ArgumentParser(add_help=False)
+	downloads.add_argument('--download-directory', default=download_directory, help='directory of downloaded products (default: %(default)s)')
+
+	queries = argparse.ArgumentParser(add_help=False)
+	queries.add_argument('--max-cloud-percentage', type=int, default=max_cloud_percentage, help='maximum cloud cover of the products (default: %(default)s)')
+	queries.add_argument('--query-workers', type=int, default=query_workers, help='concurrent queries (default: %(default)s)')
+	queries.add_argument('--band-fetch', action=argparse.BooleanOptionalAction, default=band_fetch, help='download only the bands instead of the full zip-files (default: %(default)s)')
+
+	extracts = argparse.ArgumentParser(add_help=False)
+	extracts.add_argument('--unzip-workers', type=int, default=unzip_workers, help='zip-files extracted at the same time (default: %(default)s)')
+
+	outputs = argparse.ArgumentParser(add_help=False)
+	outputs.add_argument('--output-directory', default=processed_image_directory, help='directory of the processed images (default: %(default)s)')
+
+	renders = argparse.ArgumentParser(add_help=False)
+	renders.add_argument('-w', '--workers', type=int, default=workers, help='processes used to make the images (default: %(default)s)')
+	renders.add_argument('-n', type=int, default=n, help='root of each band in the RGB composite (default: %(default)s)')
+	renders.add_argument('--engine', choices=['matplotlib', 'pil'], default=engine, help='rendering engine (default: %(default)s)')
+	renders.add_argument('--ledger', default=ledger_path, help='ledger of processed scenes (default: %(default)s)')
+	renders.add_argument('--force', action='store_true', help='process all scenes, also those already processed')
+	renders.add_argument('--min-quality', type=float, default=min_quality, help='minimum fraction of the glacier window with data and without cloud (default: %(default)s)')
+	renders.add_argument('--no-quality-check', dest='min_quality', action='store_const', const=None, help='render all scenes without checking their quality')
+	renders.add_argument('--cutout-directory', default=cutout_directory, help='directory of the scene cutouts reused when images are made again (default: %(default)s)')
+	renders.add_argument('--no-cutouts', dest='cutout_directory', action='store_const', const=None, help='do not keep scene cutouts')
+	renders.add_argument('--shared-reads', action=argparse.BooleanOptionalAction, default=shared_reads, help='make the scenes of glaciers sharing a tile together, decoding the tile once (default: %(default)s)')
+	renders.add_argument('--gdal-cache-mb', type=int, default=gdal_cache_mb, help='GDAL block cache of each process in MB (default: %(default)s)')
+	renders.add_argument('--max-store-gb', type=float, default=max_store_gb, help='maximum size of the image store in GB (default: %(default)s)')
+	renders.add_argument('--max-cutout-gb', type=float, default=max_cutout_gb, help='maximum size of the cutout store in GB (default: %(default)s)')
+
+	cubes = argparse.ArgumentParser(add_help=False)
+	cubes.add_argument('--cube-directory', default=cube_directory, help='directory of the time series cubes (default: %(default)s)')
+	cubes.add_argument('--no-cube', dest='cube_directory', action='store_const', const=None, help='do not add the scenes to the time series cubes')
 
-if upload:
-	sentinelsat_ftp_upload(processed_image_directory, processed_image_uploaded_directory)
+	uploads = argparse.ArgumentParser(add_help=False)
+	uploads.add_argument('--ftp-workers', type=int, default=ftp_workers, help='concurrent ftp sessions (default: %(default)s)')
+	uploads.add_argument('--uploaded-directory', default=processed_image_uploaded_directory, help='directory uploaded images are moved to (default: %(default)s)')
 
+	command = commands.add_parser('download', parents=[common, glaciers, dates, store, downloads, queries], help='download new products')
+	command.set_defaults(function=download)
+	command = commands.add_parser('extract', parents=[common, store, downloads, extracts], help='extract downloaded products to the image store')
+	command.set_defaults(function=extract)
+	command = commands.add_parser('render', parents=[common, glaciers, dates, store, outputs, renders, cubes], help='make the images of new or changed scenes')
+	command.set_defaults(function=render)
+	command = commands.add_parser('upload', parents=[common, outputs, uploads], help='upload the processed images')
+	command.set_defaults(function=upload)
+	command = commands.add_parser('timelapse', parents=[common, glaciers, store], help='make time lapses and change images from the time series cubes')
+	command.add_argument('--cube-directory', default=cube_directory, help='directory of the time series cubes (default: %(default)s)')
+	command.add_argument('-n', type=int, default=n, help='root of each band in the RGB composite (default: %(default)s)')
+	command.add_argument('--min-quality', type=float, default=min_quality, help='minimum quality of the scenes added, see render (default: %(default)s)')
+	command.add_argument('--cutout-directory', default=cutout_directory, help='directory of the scene cutouts to read the scenes from (default: %(default)s)')
+	command.add_argument('--timelapse-directory', default=timelapse_directory, help='directory of the time lapses and change images (default: %(default)s)')
+	command.add_argument('--since', metavar='YYYYMMDD', help='first date in the time lapse (default: all dates)')
+	command.add_argument('--frame-duration', type=int, default=frame_duration, help='time each date is shown in ms (default: %(default)s)')
+	command.set_defaults(function=timelapse)
+	command = commands.add_parser('run', parents=[common, glaciers, dates, store, downloads, queries, extracts, outputs, renders, cubes, uploads], help='download, extract, render and upload')
+	command.add_argument('--download', action=argparse.BooleanOptionalAction, default=download_products, help='download new products (default: %(default)s)')
+	command.add_argument('--upload', action=argparse.BooleanOptionalAction, default=True, help='upload the images (default: %(default)s)')
+	command.add_argument('--stream', action='store_true', help='run the commands as a streaming pipeline')
+	command.add_argument('--download-workers', type=int, default=download_workers, help='products downloaded at the same time with --stream (default: %(default)s)')
+	command.add_argument('--max-pending-products', type=int, default=max_pending_products, help='downloaded products that may wait to be extracted with --stream (default: %(default)s)')
+	command.set_defaults(function=run)
+	return parser.parse_args(argv)
 
 
+if __name__ == '__main__': # Required for the worker processes of render_scenes
+	args = parse_arguments()
+	from sentinelsat_instrumentation import open_metrics_log, close_metrics_log, report_summary
+	if args.metrics and not args.dry_run:
+		open_metrics_log(args.metrics)
+	args.function(args)
+	if not args.dry_run:
+		report_summary()
+	close_metrics_log()
@@ -0,0 +1,167 @@
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+"""
+Functions to keep a manifest of the Sentinel products whose bands have been extracted to the unprocessed image
+directory. Products in the manifest are not downloaded again, and the extracted bands are kept between runs, so
+images can be reprocessed without network access. The size of the store is bounded by deleting the bands of the
+least recently used products.
+
+The manifest is stored as .store/product_manifest.json in the image directory, and is keyed by the product title, e.g.
+'S2A_MSIL1C_20200701T151641_N0209_R068_T22WEB_20200701T170000'. Each entry contains:
+uuid: the product id used by the Copernicus SciHub (None if not known)
+files: list of extracted band filenames in the image directory
+bytes: total size of the extracted bands
+last_access: time (seconds since epoch) the bands were last downloaded or used for an image
+"""
+
+MANIFEST_NAME = 'product_manifest.json'
+PRODUCT_TITLE = re.compile(r'^S2[A-D]_MSI\w+_(?P<sensing_time>\d{8}T\d{6})_N(?P<baseline>\d{4})_R(?P<relative_orbit>\d{3})_T(?P<tile>\d{2}[A-Z]{3})_(?P<generation_time>\d{8}T\d{6})')
+STORE_FOLDER = '.store' # Folder in the image directory for the manifest and other bookkeeping files
+
+
+def store_path(image_directory, name):
+    """
+    Returns the path of the bookkeeping file name in image_directory. These are kept in a separate folder, so writing
+    them does not change the modification time of image_directory itself (see sentinelsat_catalog.py).
+    """
+    os.makedirs(os.path.join(image_directory, STORE_FOLDER), exist_ok=True)
+    return os.path.join(image_directory, STORE_FOLDER, name)
+
+
+def load_manifest(image_directory):
+    """
+    Returns the product manifest of image_directory as a dict keyed by product title. Empty if there is no manifest.
+    """
+    manifest_path = store_path(image_directory, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+
+def save_manifest(image_directory, manifest):
+    """
+    Writes manifest to image_directory. The file is replaced in one step, so an interrupted run cannot leave a
+    half-written manifest behind.
+    """
+    manifest_path = store_path(image_directory, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def product_key(title):
+    """
+    Returns (tile, sensing time, processing baseline) of the product title, e.g.
+    'S2A_MSIL1C_20200701T151641_N0209_R068_T22WEB_20200701T170000' -> ('22WEB', '20200701T151641', '0209'), or None if
+    title is not formatted like this. Products of the same tile and sensing time are the same acquisition, processed
+    again with another baseline or delivered in another orbit, and extract to the same band filenames.
+    """
+    match = PRODUCT_TITLE.match(title)
+    if match is None:
+        return None
+    return match.group('tile'), match.group('sensing_time'), match.group('baseline')
+
+
+def _stored_baselines(manifest):
+    """
+    Returns a dict of (tile, sensing time): newest processing baseline of the products in manifest
+    """
+    baselines = {}
+    for title in manifest:
+        key = product_key(title)
+        if key is not None:
+            baselines[key[:2]] = max(baselines.get(key[:2], ''), key[2])
+    return baselines
+
+
+def new_products(products, image_directory):
+    """
+    Returns the products that are not already in the store of image_directory. Products of an acquisition (tile and
+    sensing time) already in the store are also left out, unless they have a newer processing baseline.
+    products: OrderedDict of product id: product properties, as returned by SentinelAPI.query
+    """
+    manifest = load_manifest(image_directory)
+    baselines = _stored_baselines(manifest)
+    new = OrderedDict()
+    for uuid, properties in products.items():
+        if properties['title'] in manifest:
+            continue
+        key = product_key(properties['title'])
+        if key is not None and key[2] <= baselines.get(key[:2], ''):
+            continue
+        new[uuid] = properties
+    return new
+
+
+def register_products(image_directory, extracted, products=None):
+    """
+    Adds extracted products to the store of image_directory. Other products of the same acquisition (tile and sensing
+    time), e.g. with an older processing baseline, are removed from the manifest, as their band files have the same
+    names and are replaced by the extracted ones, so their bytes are not counted twice.
+    extracted: dict of product title: list of band filenames extracted to image_directory, as returned by unzip_images
+    products: OrderedDict of product id: product properties, used to look up the uuid of each title. Optional.
+    """
+    uuids = {properties['title']: uuid for uuid, properties in (products or {}).items()}
+    manifest = load_manifest(image_directory)
+    now = time.time()
+    for title, files in extracted.items():
+        files = [f for f in files if os.path.exists(os.path.join(image_directory, f))]
+        key = product_key(title)
+        if key is not None:
+            for other in list(manifest):
+                other_key = product_key(other)
+                if other != title and other_key is not None and other_key[:2] == key[:2]:
+                    del manifest[other]
+        manifest[title] = {
+            'uuid': uuids.get(title, manifest.get(title, {}).get('uuid')),
+            'files': sorted(files),
+            'bytes': sum(os.path.getsize(os.path.join(image_directory, f)) for f in files),
+            'last_access': now,
+        }
+    save_manifest(image_directory, manifest)
+
+
+def touch_files(image_directory, filenames):
+    """
+    Marks the products containing any of filenames as used now, so they are the last to be evicted
+    filenames: list of band filenames or paths in image_directory
+    """
+    filenames = set(os.path.basename(f) for f in filenames)
+    manifest = load_manifest(image_directory)
+    now = time.time()
+    for entry in manifest.values():
+        if filenames.intersection(entry['files']):
+            entry['last_access'] = now
+    save_manifest(image_directory, manifest)
+
+
+def evict_products(image_directory, max_bytes):
+    """
+    Deletes the bands of the least recently used products until the store of image_directory is at most max_bytes.
+    Files shared with a product that is kept (e.g. a reprocessed product with the same band filenames) are not deleted.
+
+    returns: list of titles of the evicted products
+    """
+    manifest = load_manifest(image_directory)
+    total_bytes = sum(entry['bytes'] for entry in manifest.values())
+    evicted = []
+    for title in sorted(manifest, key=lambda t: manifest[t]['last_access']):
+        if total_bytes <= max_bytes:
+            break
+        entry = manifest.pop(title)
+        kept_files = set(f for e in manifest.values() for f in e['files'])
+        for filename in entry['files']:
+            file_path = os.path.join(image_directory, filename)
+            if filename not in kept_files and os.path.exists(file_path):
+                os.remove(file_path)
+        total_bytes -= entry['bytes']
+        evicted.append(title)
+    if evicted:
+        save_manifest(image_directory, manifest)
+        print('Evicted {} products from {}'.format(len(evicted), image_directory))
+    return evicted
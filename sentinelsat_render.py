@@ -0,0 +1,138 @@
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+from matplotlib.font_manager import FontProperties, findfont
+from PIL import Image, ImageDraw, ImageFont
+
+"""
+Fast rendering engine for make_image (engine='pil'), which draws the image directly into pixel buffers with Pillow
+instead of building a matplotlib figure.
+
+The layout follows the matplotlib engine: the scene fills the large (LA) image at 300 dpi, with the ice extent outline
+in red, the legend in the upper left corner, a 10 km scalebar in the upper right corner and the glacier name and date
+in the lower left corner. Sizes given in points in the matplotlib engine are converted with PT pixels per point. The
+small (SM) image is downsampled from the large one instead of being drawn again.
+"""
+
+PT = 300 / 72 # Pixels per point in the large image (300 dpi)
+SM_FACTOR = 3 # The small image is 100 dpi
+
+
+@lru_cache(maxsize=None)
+def label_font(size):
+    """
+    Returns the default matplotlib font (DejaVu Sans) at size points of the large image, for the labels drawn with Pillow
+    """
+    return ImageFont.truetype(findfont(FontProperties(family=['DejaVu Sans'])), int(round(size * PT)))
+
+
+def _to_pixels(coords, bounds, scale):
+    """
+    Returns the map coordinates coords as pixel coordinates in an image of bounds with scale pixels per meter
+    """
+    minx, miny, maxx, maxy = bounds
+    return [((x - minx) * scale, (maxy - y) * scale) for x, y in coords]
+
+
+def _draw_outline(draw, outline, bounds, scale, width):
+    """
+    Draws the lines of the GeoSeries outline in red
+    """
+    for geometry in outline:
+        for line in getattr(geometry, 'geoms', [geometry]):
+            coords = list(getattr(line, 'coords', []))
+            if len(coords) > 1:
+                draw.line(_to_pixels(coords, bounds, scale), fill=(255, 0, 0, 255), width=width)
+
+
+def render_image(glacier, date, rgba, transform, bounds, outline, filename, filename_SM, width=2280):
+    """
+    Renders the image of glacier, and writes the large and small png files
+
+    glacier: string containing glacier name
+    date: str formatted  "YYYYMMDDTHHMMSS". ex "20200115T230203"
+    rgba: float array of shape (height, width, 4) with the normalized scene, as made by make_image
+    transform: Affine transform of rgba
+    bounds: (minx, miny, maxx, maxy) of the image in the projection of rgba
+    outline: GeoSeries of ice extent lines within bounds
+    filename, filename_SM: paths of the large and small image, without .png
+    width: width of the large image in pixels
+    """
+    minx, miny, maxx, maxy = bounds
+    scale = width / (maxx - minx) # Pixels per meter
+    height = int(round((maxy - miny) * scale))
+
+    #%% Resample the scene to the image. Premultiplied alpha, so pixels without data do not darken the edges
+    res = transform.a
+    box = ((minx - transform.c) / res, (transform.f - maxy) / res, (maxx - transform.c) / res, (transform.f - miny) / res)
+    scene = Image.fromarray((rgba * 255 + 0.5).astype(np.uint8), 'RGBA').convert('RGBa')
+    scene = scene.resize((width, height), Image.LANCZOS, box=box).convert('RGBA')
+    image = Image.new('RGBA', (width, height), 'white')
+    image.alpha_composite(scene)
+    del scene
+
+    draw = ImageDraw.Draw(image)
+    _draw_outline(draw, outline, bounds, scale, max(1, int(round(PT))))
+
+    # Boxes are drawn on a transparent layer, as they have alpha 0.8
+    boxes = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    box_draw = ImageDraw.Draw(boxes)
+    box_fill = (255, 255, 255, 204)
+    box_edge = (0, 0, 0, 204)
+    texts = []
+
+    #%% Legend in the upper left corner
+    font = label_font(10)
+    fontsize = 10 * PT
+    title_box = box_draw.textbbox((0, 0), 'Ice extent', font=font)
+    label_box = box_draw.textbbox((0, 0), '1980', font=font)
+    row_height = max(title_box[3], label_box[3])
+    handle_length = 2 * fontsize
+    content_width = max(title_box[2], handle_length + 0.8 * fontsize + label_box[2])
+    left = top = 0.5 * fontsize
+    right = left + content_width + 2 * 0.4 * fontsize
+    bottom = top + 2 * row_height + 0.5 * fontsize + 2 * 0.4 * fontsize
+    box_draw.rectangle((left, top, right, bottom), fill=box_fill, outline=box_edge, width=max(1, int(round(0.8 * PT))))
+    row_top = top + 0.4 * fontsize
+    texts.append(((left + right) / 2, row_top, 'Ice extent', font, 'ma'))
+    row_top += row_height + 0.5 * fontsize
+    handle_left = left + 0.4 * fontsize
+    handle_y = row_top + row_height / 2
+    texts.append((handle_left + handle_length + 0.8 * fontsize, row_top, '1980', font, 'la'))
+
+    #%% 10 km scalebar in the upper right corner
+    bar_length = 10000 * scale
+    bar_height = max(1, 0.01 * height)
+    label_box = box_draw.textbbox((0, 0), '10 km', font=font)
+    pad = 0.2 * fontsize
+    right = width - fontsize
+    top = fontsize
+    left = right - max(bar_length, label_box[2]) - 2 * pad
+    bottom = top + 2 * pad + bar_height + 5 * PT + label_box[3]
+    box_draw.rectangle((left, top, right, bottom), fill=box_fill)
+    bar_left = (left + right - bar_length) / 2
+    bar = (bar_left, top + pad, bar_left + bar_length, top + pad + bar_height)
+    texts.append(((left + right) / 2, top + pad + bar_height + 5 * PT, '10 km', font, 'ma'))
+
+    #%% Glacier name and date in the lower left corner
+    date_font = label_font(16)
+    dateString = datetime.strptime(date[0:8], '%Y%m%d').strftime("%d %B %Y")
+    label = '{} glacier, {}'.format(glacier, dateString)
+    x = y = 0.035 * height
+    text_box = box_draw.textbbox((x, height - y), label, font=date_font, anchor='ls')
+    box_draw.rectangle((text_box[0] - 4 * PT, text_box[1] - 4 * PT, text_box[2] + 4 * PT, text_box[3] + 4 * PT), fill=box_fill, outline=box_edge, width=max(1, int(round(PT))))
+    texts.append((x, height - y, label, date_font, 'ls'))
+
+    image.alpha_composite(boxes)
+    del boxes
+    draw = ImageDraw.Draw(image)
+    draw.line((handle_left, handle_y, handle_left + handle_length, handle_y), fill=(255, 0, 0, 255), width=max(1, int(round(PT))))
+    draw.rectangle(bar, fill='black')
+    for x, y, text, font, anchor in texts:
+        draw.text((x, y), text, fill='black', font=font, anchor=anchor)
+
+    #%% Save both sizes. The small image is downsampled from the large one
+    image = image.convert('RGB')
+    image.save(filename + '.png')
+    image.resize((int(round(width / SM_FACTOR)), int(round(height / SM_FACTOR))), Image.LANCZOS).save(filename_SM + '.png')
@@ -0,0 +1,240 @@
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+from affine import Affine
+from PIL import Image, ImageDraw
+
+from sentinelsat_glacier_definitions import GLACIERS
+from sentinelsat_functions import decimation_factor, mosaic_grid, scene_rgba
+from sentinelsat_instrumentation import stage
+from sentinelsat_render import label_font
+
+"""
+Functions to keep a time series cube of each glacier: the normalized scenes of all dates in one fixed grid, from
+which time lapses and change images are made without decoding the band images again.
+
+The cube of a glacier is stored in <cube_directory>/<glacier>/ as
+frames.dat: the frames as raw uint8 RGBA (alpha 0 where no tile has data), one after the other, so the file can be
+read with numpy.memmap as an array of shape (frames, height, width, 4)
+index.json: the grid of the frames (crs, transform and shape), and for each date the number of its frame in
+frames.dat, the root n it was made with, and the name and size of its band images
+
+The grid is the bounding box of the glacier in its UTM zone, at the resolution that gives frames at least CUBE_WIDTH
+pixels wide. The grid is the same for all dates, so a pixel is the same place in all frames.
+
+New dates are appended to the end of frames.dat, so adding the scenes of a run only costs the new frames. A date made
+again from changed band images or with another n overwrites its own frame. The frames are made from the cutout store
+(see sentinelsat_cutouts.py) when it has the scene, and only decoded from the band images otherwise.
+
+Time lapses (GIF) and change images (PNG) read one frame at a time from the memory map. Pillow keeps all frames of a
+GIF in memory until it is written, so long time lapses are limited with since.
+"""
+
+CUBE_DIRECTORY = './timeseries.nosync'
+CUBE_WIDTH = 1140 # Minimum width in pixels of the frames
+FRAMES_NAME = 'frames.dat'
+INDEX_NAME = 'index.json'
+S2_RESOLUTION = 10 # Pixel size in m of the B02, B03 and B04 bands
+DIFFERENCE_RANGE = 0.3 # Change in brightness (0-1) shown with the strongest color in change images
+
+
+def cube_grid(glacier):
+    """
+    Returns (crs, transform, shape) of the fixed grid of the cube of glacier
+    """
+    record = GLACIERS[glacier]
+    minx, miny, maxx, maxy = record.utm_bounds
+    factor = decimation_factor((maxx - minx) / S2_RESOLUTION, CUBE_WIDTH)
+    transform, shape = mosaic_grid(Affine(S2_RESOLUTION, 0, 0, 0, -S2_RESOLUTION, 0), record.utm_bounds, factor)
+    return 'epsg:{}'.format(record.epsg), transform, shape
+
+
+def _cube_path(cube_directory, glacier, name):
+    return os.path.join(cube_directory, glacier, name)
+
+
+def load_cube_index(cube_directory, glacier):
+    """
+    Returns the index of the cube of glacier, as described in the module docstring, with 'dates' as a dict of date:
+    dict with keys 'frame', 'n' and 'images'. A new empty index if the glacier has no cube yet.
+    """
+    index_path = _cube_path(cube_directory, glacier, INDEX_NAME)
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as file:
+            return json.load(file)
+    crs, transform, shape = cube_grid(glacier)
+    return {'crs': crs, 'transform': list(transform)[:6], 'shape': list(shape), 'dates': {}}
+
+
+def _save_cube_index(cube_directory, glacier, index):
+    index_path = _cube_path(cube_directory, glacier, INDEX_NAME)
+    with open(index_path + '.tmp', 'w') as file:
+        json.dump(index, file, indent=1, sort_keys=True)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def sample_frame(rgba, transform, grid_transform, grid_shape):
+    """
+    Returns the normalized scene rgba (as made by scene_rgba) resampled to the grid of the cube with nearest
+    neighbour, as a uint8 array of shape (height, width, 4)
+
+    transform: Affine transform of rgba
+    grid_transform, grid_shape: grid of the cube, see cube_grid
+    """
+    step = grid_transform.a
+    xs = grid_transform.c + (np.arange(grid_shape[1]) + 0.5) * step
+    ys = grid_transform.f - (np.arange(grid_shape[0]) + 0.5) * step
+    cols = np.floor((xs - transform.c) / transform.a).astype(int)
+    rows = np.floor((ys - transform.f) / transform.e).astype(int)
+    inside_cols = np.flatnonzero((cols >= 0) & (cols < rgba.shape[1]))
+    inside_rows = np.flatnonzero((rows >= 0) & (rows < rgba.shape[0]))
+
+    frame = np.zeros(tuple(grid_shape) + (4,), dtype=np.uint8)
+    scene = rgba[np.ix_(rows[inside_rows], cols[inside_cols])]
+    frame[np.ix_(inside_rows, inside_cols)] = np.clip(scene * 255 + 0.5, 0, 255).astype(np.uint8)
+    return frame
+
+
+def append_scenes(scenes, n, cube_directory=CUBE_DIRECTORY, cutout_directory=None):
+    """
+    Adds the scenes to the cubes of their glaciers. Scenes already in a cube with the same band images and n are left
+    out.
+
+    scenes: list of (glacier, date, image_list) tuples, as returned by glacier_scenes
+    n: integer (1-10) for RGB composition. band = band^(1/n)
+    cutout_directory: string containing the directory of the cutout store to read the scenes from. Defaults to None
+    (decode the band images)
+
+    returns: integer number of frames written
+    """
+    written = 0
+    for glacier in sorted(set(scene[0] for scene in scenes)):
+        os.makedirs(os.path.join(cube_directory, glacier), exist_ok=True)
+        index = load_cube_index(cube_directory, glacier)
+        grid_transform = Affine(*index['transform'])
+        grid_shape = tuple(index['shape'])
+        frame_bytes = grid_shape[0] * grid_shape[1] * 4
+        frames_path = _cube_path(cube_directory, glacier, FRAMES_NAME)
+        count = len(index['dates'])
+
+        # Leave out the end of a frame written by an interrupted run, but not added to the index
+        with open(frames_path, 'ab') as file:
+            file.truncate(count * frame_bytes)
+
+        for scene_glacier, date, image_list in scenes:
+            if scene_glacier != glacier:
+                continue
+            images = [[os.path.basename(image), os.path.getsize(image)] for image in sorted(image_list)]
+            entry = index['dates'].get(date)
+            if entry is not None and entry['n'] == n and entry['images'] == images:
+                continue
+            try:
+                with stage('cube_frame', glacier=glacier, date=date):
+                    rgba, transform, bounds, to_crs = scene_rgba(glacier, n, image_list, cutout_directory)
+                    if to_crs != index['crs']:
+                        raise ValueError('Scene in {} instead of {}'.format(to_crs, index['crs']))
+                    frame = sample_frame(rgba, transform, grid_transform, grid_shape)
+            except Exception as e:
+                print('Failed to add {} {} to the time series. Reason: {}'.format(glacier, date, e))
+                continue
+
+            number = entry['frame'] if entry is not None else count
+            with open(frames_path, 'r+b') as file:
+                file.seek(number * frame_bytes)
+                file.write(frame.tobytes())
+            if entry is None:
+                count += 1
+            index['dates'][date] = {'frame': number, 'n': n, 'images': images}
+            _save_cube_index(cube_directory, glacier, index) # After the frame, so the index never points to a missing frame
+            written += 1
+    return written
+
+
+def cube_frames(glacier, cube_directory=CUBE_DIRECTORY, since=None):
+    """
+    Yields (date, frame) for the dates in the cube of glacier, in order of date. The frames are views of the memory
+    mapped frames.dat, so only the frames used are read.
+
+    since: string formatted 'YYYYMMDD' with the first date to yield. Defaults to None (all dates)
+    """
+    index = load_cube_index(cube_directory, glacier)
+    if not index['dates']:
+        return
+    shape = tuple(index['shape'])
+    frames = np.memmap(_cube_path(cube_directory, glacier, FRAMES_NAME), dtype=np.uint8, mode='r', shape=(len(index['dates']),) + shape + (4,))
+    for date in sorted(index['dates']):
+        if since is None or date[:8] >= since:
+            yield date, frames[index['dates'][date]['frame']]
+
+
+def _labelled(image, label):
+    """
+    Draws label in the lower left corner of image
+    """
+    draw = ImageDraw.Draw(image)
+    font = label_font(4)
+    x = y = int(0.03 * image.height)
+    text_box = draw.textbbox((x, image.height - y), label, font=font, anchor='ls')
+    draw.rectangle((text_box[0] - 4, text_box[1] - 4, text_box[2] + 4, text_box[3] + 4), fill='white')
+    draw.text((x, image.height - y), label, fill='black', font=font, anchor='ls')
+    return image
+
+
+def _date_string(date):
+    return datetime.strptime(date[0:8], '%Y%m%d').strftime("%d %B %Y")
+
+
+def timelapse_gif(glacier, path, cube_directory=CUBE_DIRECTORY, since=None, frame_duration=500):
+    """
+    Writes a time lapse of the frames in the cube of glacier as an animated GIF to path. Frames are read from the
+    memory map and converted one at a time, but the Pillow GIF writer keeps all converted frames (one byte per pixel) in
+    memory until the file is written, so the memory used grows with the number of dates. Use since to limit it. Pixels
+    without data are black.
+
+    since: string formatted 'YYYYMMDD' with the first date. Defaults to None (all dates)
+    frame_duration: integer time each frame is shown in ms
+
+    returns: integer number of frames in the time lapse
+    """
+    count = [0]
+
+    def gif_frames():
+        for date, frame in cube_frames(glacier, cube_directory, since):
+            image = Image.new('RGBA', (frame.shape[1], frame.shape[0]), 'black')
+            image.alpha_composite(Image.fromarray(np.asarray(frame), 'RGBA'))
+            image = _labelled(image.convert('RGB'), '{} glacier, {}'.format(glacier, _date_string(date)))
+            count[0] += 1
+            yield image.convert('P', palette=Image.ADAPTIVE)
+
+    frames = gif_frames()
+    first = next(frames, None)
+    if first is None:
+        return 0
+    with stage('timelapse', glacier=glacier):
+        first.save(path, save_all=True, append_images=frames, duration=frame_duration, loop=0)
+    return count[0]
+
+
+def difference_image(glacier, first_date, last_date, path, cube_directory=CUBE_DIRECTORY):
+    """
+    Writes a png image to path of the change in brightness of glacier from first_date to last_date. Pixels that got
+    darker (e.g. ice replaced by open water) are red, pixels that got brighter are blue, with the strongest color at a
+    change of DIFFERENCE_RANGE. Pixels without data in one of the frames are gray.
+    """
+    frames = dict(cube_frames(glacier, cube_directory, min(first_date, last_date)[:8]))
+    first = np.asarray(frames[first_date])
+    last = np.asarray(frames[last_date])
+    valid = (first[..., 3] > 0) & (last[..., 3] > 0)
+    change = (last[..., :3].mean(axis=-1, dtype=np.float32) - first[..., :3].mean(axis=-1, dtype=np.float32)) / 255
+    t = np.clip(change / DIFFERENCE_RANGE, -1, 1)
+
+    # White for no change, going to red (darker) or blue (brighter)
+    rgb = np.empty(t.shape + (3,), dtype=np.float32)
+    rgb[..., 0] = 1 - np.clip(t, 0, 1)
+    rgb[..., 1] = 1 - np.abs(t)
+    rgb[..., 2] = 1 + np.clip(t, -1, 0)
+    rgb[~valid] = 0.5
+    image = Image.fromarray((rgb * 255 + 0.5).astype(np.uint8), 'RGB')
+    _labelled(image, '{} glacier, {} to {}'.format(glacier, _date_string(first_date), _date_string(last_date))).save(path)